@@ -0,0 +1,2 @@
+# parity checks and timings, run from the repository root as e.g.
+#   python -m benchmarks.benchmark_blur
@@ -0,0 +1,73 @@
+import argparse
+import time
+import numpy as np
+from src.Dataset import DataSet
+
+
+def rotate_loop(dataX, dataY, ks):
+    """ Per-sample, per-frame reference (the previous DataSet.augment) """
+    for i, k in enumerate(ks):
+        if k > 0:
+            for j in range(dataX.shape[1]):
+                dataX[i][j] = np.rot90(dataX[i][j], k)
+            rad = k * (np.pi / 2.0)
+            fx, fy = np.copy(dataY[i][:, :, 0]), np.copy(dataY[i][:, :, 1])
+            dataY[i][..., 0] = (fx * np.cos(rad)) - (fy * np.sin(rad))
+            dataY[i][..., 1] = (fx * np.sin(rad)) + (fy * np.cos(rad))
+            dataY[i] = np.rot90(dataY[i], k)
+    return dataX, dataY
+
+
+def rotate_grouped(d, dataX, dataY, ks):
+    for k in range(1, 4):
+        indices = np.flatnonzero(ks == k)
+        if len(indices):
+            dataX[indices] = d.discrete_rotate(dataX[indices], k,
+                                               axes=(2, 3))
+            dataY[indices] = d.discrete_rotate(dataY[indices], k,
+                                               flow=True, axes=(1, 2))
+    return dataX, dataY
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Parity check and timing of the grouped batch rotation '
+                    'vs. the per-sample loop it replaces')
+    parser.add_argument('--size', type=int, default=384,
+                        help='Square frame size (the loop only supports '
+                             'square frames for odd quarter turns)')
+    parser.add_argument('--batch_sizes', type=int, nargs='+',
+                        default=[4, 16, 64])
+    parser.add_argument('--iterations', type=int, default=10)
+    args = parser.parse_args()
+
+    d = DataSet(train=[], validation=[])
+    for batch_size in args.batch_sizes:
+        dataX = np.random.rand(batch_size, 2, args.size, args.size,
+                               1).astype('float32')
+        dataY = np.random.randn(batch_size, args.size, args.size,
+                                2).astype('float32')
+        ks = np.random.randint(0, 4, batch_size)
+
+        # parity
+        loopX, loopY = rotate_loop(dataX.copy(), dataY.copy(), ks)
+        groupedX, groupedY = rotate_grouped(d, dataX.copy(), dataY.copy(),
+                                            ks)
+        print 'batch %d max abs diff: frames %g, flows %g' % \
+            (batch_size, np.abs(loopX - groupedX).max(),
+             np.abs(loopY - groupedY).max())
+
+        timings = []
+        for rotate in [lambda x, y: rotate_loop(x, y, ks),
+                       lambda x, y: rotate_grouped(d, x, y, ks)]:
+            start = time.time()
+            for i in range(args.iterations):
+                rotate(dataX.copy(), dataY.copy())
+            timings.append((time.time() - start) / args.iterations)
+        print '  loop:    %.3f ms' % (timings[0] * 1000)
+        print '  grouped: %.3f ms (%.2fx)' % (timings[1] * 1000,
+                                              timings[0] / timings[1])
+
+
+if __name__ == '__main__':
+    main()
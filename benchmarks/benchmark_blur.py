@@ -0,0 +1,57 @@
+import argparse
+import numpy as np
+import tensorflow as tf
+from src.graph_components import blur_downsample3d
+from benchmarks.common import time_run
+
+
+def build(input_layer, num_scales, separable):
+    levels = [input_layer]
+    for scale in range(1, num_scales):
+        levels.append(blur_downsample3d('input_downsample_' + str(scale),
+                                        levels[-1], 5, 2, sigma=2,
+                                        separable=separable))
+    return levels[1:]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Parity check and timing of the separable vs. dense '
+                    'blur_downsample3d pyramid')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--height', type=int, default=384)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--num_scales', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--device', type=str, default='/cpu:0')
+    args = parser.parse_args()
+
+    data = np.random.rand(args.batch_size, 2, args.height, args.width,
+                          1).astype('float32')
+
+    with tf.Graph().as_default(), tf.device(args.device):
+        input_layer = tf.placeholder(tf.float32, [None, 2, None, None, 1])
+        dense = build(input_layer, args.num_scales, separable=False)
+        separable = build(input_layer, args.num_scales, separable=True)
+        with tf.Session() as sess:
+            feed_dict = {input_layer: data}
+
+            # parity
+            dense_levels, separable_levels = \
+                sess.run([dense, separable], feed_dict=feed_dict)
+            for scale, (d, s) in enumerate(zip(dense_levels,
+                                               separable_levels)):
+                assert d.shape == s.shape, (d.shape, s.shape)
+                print 'scale %d %s max abs diff: %g' % \
+                    (scale + 1, d.shape, np.abs(d - s).max())
+
+            dense_time = time_run(sess, dense, args.iterations, feed_dict)
+            separable_time = time_run(sess, separable, args.iterations,
+                                      feed_dict)
+            print 'dense:     %.3f ms' % (dense_time * 1000)
+            print 'separable: %.3f ms (%.2fx)' % \
+                (separable_time * 1000, dense_time / separable_time)
+
+
+if __name__ == '__main__':
+    main()
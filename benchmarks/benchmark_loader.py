@@ -0,0 +1,72 @@
+import argparse
+import time
+import threading
+from src.Dataset import load_dataset
+from src.ProcessLoader import ProcessLoader
+
+
+def thread_throughput(dataset, batch_size, n_threads, num_batches):
+    """ samples/sec of the current GIL-bound thread loader """
+    counts = [0] * n_threads
+
+    def worker(n):
+        while counts[n] < num_batches / n_threads:
+            dataset.next_batch(batch_size)
+            counts[n] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(n_threads)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts) * batch_size / (time.time() - start)
+
+
+def process_throughput(dataset, input_shape, target_shape, batch_size,
+                       n_processes, num_batches, warmup=2):
+    """ samples/sec of the shared-memory process loader """
+    loader = ProcessLoader(dataset, input_shape, target_shape, batch_size,
+                           n_processes)
+    loader.start()
+    for i in range(warmup):
+        slot, _, _ = loader.get()
+        loader.release(slot)
+    start = time.time()
+    for i in range(num_batches):
+        slot, _, _ = loader.get()
+        loader.release(slot)
+    samples_per_sec = num_batches * batch_size / (time.time() - start)
+    loader.stop()
+    return samples_per_sec
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure loader samples/sec from 1 to N workers')
+    parser.add_argument('--train_filename', type=str, required=True,
+                        help='Dataset directory (FlyingChairs or UCF101)')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--max_workers', type=int, default=8)
+    parser.add_argument('--num_batches', type=int, default=100)
+    parser.add_argument('--crop_size', type=int, nargs=2, default=None,
+                        help='Load random height x width crops')
+    parser.add_argument('--patches_per_sample', type=int, default=1)
+    args = parser.parse_args()
+
+    d = load_dataset(args.train_filename)
+    d.set_crop(args.crop_size, args.patches_per_sample)
+
+    input_shape, target_shape = d.sample_shapes()
+
+    print '%8s %16s %16s' % ('workers', 'threads (smp/s)', 'processes (smp/s)')
+    for n in range(1, args.max_workers + 1):
+        threads = thread_throughput(d, args.batch_size, n, args.num_batches)
+        processes = process_throughput(d, input_shape, target_shape,
+                                       args.batch_size, n, args.num_batches)
+        print '%8d %16.1f %16.1f' % (n, threads, processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import numpy as np
+import tensorflow as tf
+from src.graph_components import blur_downsample3d
+from src.MSOEnet import MSOEnet, MSOEnetPacked
+from benchmarks.common import time_run
+
+
+def build_levels(input_layer, num_scales):
+    levels = [input_layer]
+    for scale in range(1, num_scales):
+        levels.append(blur_downsample3d('input_downsample_' + str(scale),
+                                        levels[-1], 5, 2, sigma=2))
+    return levels
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Parity check and timing of the per-scale MSOEnets vs. '
+                    'a single MSOEnetPacked over an atlas of all scales')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--height', type=int, default=384)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--num_scales', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--intra_op_threads', type=int, default=0)
+    parser.add_argument('--device', type=str, default='/cpu:0')
+    args = parser.parse_args()
+
+    data = np.random.rand(args.batch_size, 2, args.height, args.width,
+                          1).astype('float32')
+    config = tf.ConfigProto(
+        intra_op_parallelism_threads=args.intra_op_threads)
+
+    with tf.Graph().as_default(), tf.device(args.device):
+        input_layer = tf.placeholder(tf.float32, [None, 2, None, None, 1])
+        levels = build_levels(input_layer, args.num_scales)
+        separate = [MSOEnet('MSOEnet_' + str(scale), levels[scale],
+                            reuse=True if scale else None).output
+                    for scale in range(args.num_scales)]
+        packed = MSOEnetPacked('MSOEnet_packed', levels, reuse=True).outputs
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            feed_dict = {input_layer: data}
+
+            # parity
+            separate_levels, packed_levels = \
+                sess.run([separate, packed], feed_dict=feed_dict)
+            for scale, (s, p) in enumerate(zip(separate_levels,
+                                               packed_levels)):
+                assert s.shape == p.shape, (s.shape, p.shape)
+                print 'scale %d %s max abs diff: %g' % \
+                    (scale, s.shape, np.abs(s - p).max())
+
+            separate_time = time_run(sess, separate, args.iterations,
+                                     feed_dict)
+            packed_time = time_run(sess, packed, args.iterations, feed_dict)
+            print 'per scale: %.3f ms' % (separate_time * 1000)
+            print 'packed:    %.3f ms (%.2fx)' % \
+                (packed_time * 1000, separate_time / packed_time)
+
+
+if __name__ == '__main__':
+    main()
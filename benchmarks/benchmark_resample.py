@@ -0,0 +1,81 @@
+import argparse
+import numpy as np
+import tensorflow as tf
+from src.graph_components import bilinear_resample, bilinear_resample3d
+from benchmarks.common import time_run
+
+
+def bilinear_resample3d_unstacked(name, input_layer, output_shape, axis=1):
+    """ previous implementation: one resize op per temporal slice """
+    with tf.get_default_graph().name_scope(name):
+        unpacked = tf.unstack(input_layer, axis=axis)
+        for i in range(len(unpacked)):
+            unpacked[i] = bilinear_resample('bilinear_resample', unpacked[i],
+                                            output_shape)
+        return tf.stack(unpacked, axis=axis)
+
+
+def build(resample3d, features, shapes):
+    """ upsample every scale to the next finer one (upconv3d path) """
+    outputs = []
+    for scale in range(len(features) - 1, 0, -1):
+        outputs.append(resample3d('upsample_' + str(scale), features[scale],
+                                  shapes[scale - 1]))
+    return outputs
+
+
+def compare(args, temporal_extent):
+    shapes = [((args.height - 1) / 2**s + 1, (args.width - 1) / 2**s + 1)
+              for s in range(args.num_scales)]
+    data = [np.random.rand(args.batch_size, temporal_extent, h, w,
+                           args.channels).astype('float32')
+            for h, w in shapes]
+
+    print 'temporal extent %d' % temporal_extent
+    results = {}
+    for name, resample3d in [('unstack/stack', bilinear_resample3d_unstacked),
+                             ('folded', bilinear_resample3d)]:
+        with tf.Graph().as_default() as graph, tf.device(args.device):
+            features = [tf.placeholder(tf.float32,
+                                       [None, temporal_extent, None,
+                                        None, args.channels])
+                        for _ in shapes]
+            num_ops = len(graph.get_operations())
+            outputs = build(resample3d, features, shapes)
+            num_ops = len(graph.get_operations()) - num_ops
+
+            feed_dict = dict(zip(features, data))
+            with tf.Session() as sess:
+                results[name] = sess.run(outputs, feed_dict=feed_dict)
+                latency = time_run(sess, outputs, args.iterations, feed_dict)
+            print '  %-14s %5d ops %8.3f ms' % (name, num_ops,
+                                                latency * 1000)
+
+    diff = max(np.abs(a - b).max() for a, b in
+               zip(results['unstack/stack'], results['folded']))
+    print '  max abs diff: %g' % diff
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Op count and latency of bilinear_resample3d with and '
+                    'without the per-frame unstack/stack loop')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--temporal_extents', type=int, nargs='+',
+                        default=[1, 2],
+                        help='Frames per sample to compare at (the loop '
+                             'only differs from the folded version for 2+)')
+    parser.add_argument('--channels', type=int, default=64)
+    parser.add_argument('--height', type=int, default=384)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--num_scales', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--device', type=str, default='/cpu:0')
+    args = parser.parse_args()
+
+    for temporal_extent in args.temporal_extents:
+        compare(args, temporal_extent)
+
+
+if __name__ == '__main__':
+    main()
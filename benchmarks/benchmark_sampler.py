@@ -0,0 +1,102 @@
+import argparse
+import numpy as np
+import tensorflow as tf
+from src.augmentation import bilinearSampler, geoAugTransform, meshGridFlat
+from benchmarks.common import time_run
+
+
+def reference_sampler(im, grid, out_size):
+    """ The previous bilinearSampler (float matmul offsets, four gathers) """
+    def _repeat(x, n_repeats):
+        rep = tf.transpose(
+            tf.expand_dims(tf.ones(shape=tf.stack([n_repeats, ])), 1), [1, 0])
+        x = tf.cast(x, tf.float32)
+        x = tf.matmul(tf.reshape(x, (-1, 1)), rep)
+        x = tf.cast(x, tf.int32)
+        return tf.reshape(x, [-1])
+
+    x = tf.reshape(tf.slice(grid, [0, 0, 0], [-1, 1, -1]), [-1])
+    y = tf.reshape(tf.slice(grid, [0, 1, 0], [-1, 1, -1]), [-1])
+    num_batch = tf.shape(im)[0]
+    height = tf.shape(im)[1]
+    width = tf.shape(im)[2]
+    channels = tf.shape(im)[3]
+    height_f = tf.cast(height, 'float32')
+    width_f = tf.cast(width, 'float32')
+    zero = tf.zeros([], dtype='int32')
+    max_y = height - 1
+    max_x = width - 1
+    x = (x + 1.0) * (width_f - 1.00001) / 2.0
+    y = (y + 1.0) * (height_f - 1.00001) / 2.0
+    x0 = tf.clip_by_value(tf.cast(tf.floor(x), 'int32'), zero, max_x)
+    x1 = tf.clip_by_value(tf.cast(tf.floor(x), 'int32') + 1, zero, max_x)
+    y0 = tf.clip_by_value(tf.cast(tf.floor(y), 'int32'), zero, max_y)
+    y1 = tf.clip_by_value(tf.cast(tf.floor(y), 'int32') + 1, zero, max_y)
+    base = _repeat(tf.range(num_batch) * width * height,
+                   out_size[0] * out_size[1])
+    im_flat = tf.reshape(im, tf.stack([-1, channels]))
+    Ia = tf.gather(im_flat, base + y0 * width + x0)
+    Ib = tf.gather(im_flat, base + y1 * width + x0)
+    Ic = tf.gather(im_flat, base + y0 * width + x1)
+    Id = tf.gather(im_flat, base + y1 * width + x1)
+    x0_f = tf.cast(x0, 'float32')
+    x1_f = tf.cast(x1, 'float32')
+    y0_f = tf.cast(y0, 'float32')
+    y1_f = tf.cast(y1, 'float32')
+    wa = tf.expand_dims(((x1_f - x) * (y1_f - y)), 1)
+    wb = tf.expand_dims(((x1_f - x) * (y - y0_f)), 1)
+    wc = tf.expand_dims(((x - x0_f) * (y1_f - y)), 1)
+    wd = tf.expand_dims(((x - x0_f) * (y - y0_f)), 1)
+    output = tf.add_n([wa * Ia, wb * Ib, wc * Ic, wd * Id])
+    return tf.reshape(output, tf.stack([num_batch, out_size[0], out_size[1],
+                                        channels]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Parity check and throughput of the single-gather '
+                    'bilinearSampler vs. the previous one')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--height', type=int, default=384,
+                        help='FlyingChairs resolution by default')
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--frames', type=int, default=2)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--device', type=str, default='/cpu:0')
+    args = parser.parse_args()
+
+    B, T, H, W, C = (args.batch_size, args.frames, args.height, args.width,
+                     args.channels)
+    data = np.random.rand(B, T, H, W, C).astype('float32')
+
+    with tf.Graph().as_default(), tf.device(args.device):
+        frames = tf.constant(data)
+        transform = geoAugTransform(B, 0.1, 0.1, 0.17, 0.9, 1.1, True)
+        grid = tf.matmul(transform[:, :2], meshGridFlat(B, H, W))
+        # fixed transform, so both samplers see the same grid every run
+        grid = tf.Variable(grid, trainable=False)
+        out_size = [H, W]
+
+        # previous: one call per frame; new: all frames in one call
+        reference = tf.stack([reference_sampler(frames[:, t], grid, out_size)
+                              for t in range(T)], 1)
+        gathered = bilinearSampler(frames, grid, out_size)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            r, g = sess.run([reference, gathered])
+            print 'max abs diff: %g' % np.abs(r - g).max()
+
+            reference_time = time_run(sess, reference, args.iterations)
+            gathered_time = time_run(sess, gathered, args.iterations)
+            pixels = B * T * H * W
+            print 'previous: %.3f ms (%.1f Mpix/s)' % \
+                (reference_time * 1000, pixels / reference_time / 1e6)
+            print 'gather:   %.3f ms (%.1f Mpix/s, %.2fx)' % \
+                (gathered_time * 1000, pixels / gathered_time / 1e6,
+                 reference_time / gathered_time)
+
+
+if __name__ == '__main__':
+    main()
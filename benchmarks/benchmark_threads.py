@@ -0,0 +1,76 @@
+import argparse
+import itertools
+import re
+import subprocess
+import sys
+
+
+def run_setting(args, intra_op_threads, inter_op_threads, compute_cores):
+    """
+    Runs benchmark_train with one thread setting in a fresh process (the
+    thread pools and core affinity are per process) and returns its
+    iterations/sec
+    """
+    command = [sys.executable, '-m', 'benchmarks.benchmark_train',
+               '--train_filename', args.train_filename,
+               '--batch_size', str(args.batch_size),
+               '--num_threads', str(args.num_threads),
+               '--num_scales', str(args.num_scales),
+               '--iterations', str(args.iterations),
+               '--warmup', str(args.warmup),
+               '--modes', 'direct',
+               '--device', args.device,
+               '--intra_op_threads', str(intra_op_threads),
+               '--inter_op_threads', str(inter_op_threads)]
+    if compute_cores:
+        command += ['--compute_cores', compute_cores]
+    if args.loader_cores:
+        command += ['--loader_cores', args.loader_cores]
+    output = subprocess.check_output(command)
+    match = re.search(r'^direct\s+([0-9.]+) iter/s', output, re.MULTILINE)
+    if match is None:
+        raise RuntimeError('benchmark_train.py printed no result:\n' + output)
+    return float(match.group(1))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Sweep intra/inter-op thread pool sizes and compute core '
+                    'sets and report training iterations/sec for each')
+    parser.add_argument('--train_filename', type=str, required=True,
+                        help='Dataset directory (FlyingChairs or UCF101)')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_threads', type=int, default=6)
+    parser.add_argument('--num_scales', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--device', type=str, default='/cpu:0')
+    parser.add_argument('--intra_op_threads', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16])
+    parser.add_argument('--inter_op_threads', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('--compute_cores', type=str, nargs='+',
+                        default=[''],
+                        help='Core sets to pin the model to, e.g. 0-7 0-15 '
+                             '(empty for no pinning)')
+    parser.add_argument('--loader_cores', type=str, default=None,
+                        help='Cores to pin the data loaders to, e.g. 16-19')
+    args = parser.parse_args()
+
+    results = []
+    for intra, inter, cores in itertools.product(args.intra_op_threads,
+                                                 args.inter_op_threads,
+                                                 args.compute_cores):
+        iterations_per_sec = run_setting(args, intra, inter, cores)
+        results.append((iterations_per_sec, intra, inter, cores))
+        print 'intra %-3d inter %-3d cores %-10s %f iter/s' % \
+            (intra, inter, cores or 'all', iterations_per_sec)
+        sys.stdout.flush()
+
+    best = max(results)
+    print 'best: intra %d inter %d cores %s (%f iter/s)' % \
+        (best[1], best[2], best[3] or 'all', best[0])
+
+
+if __name__ == '__main__':
+    main()
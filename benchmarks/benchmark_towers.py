@@ -0,0 +1,54 @@
+import argparse
+from src.MSOEmultiscale import MSOEmultiscale
+from benchmarks.common import make_config
+
+
+def user_config(args, num_towers):
+    my_config = {}
+    my_config['train_filename'] = args.train_filename
+    my_config['batch_size'] = args.batch_size
+    my_config['lr'] = 6e-3
+    my_config['num_threads'] = args.num_threads
+    my_config['num_scales'] = args.num_scales
+    my_config['device'] = args.devices[0]
+    my_config['num_towers'] = num_towers
+    my_config['tower_devices'] = [args.devices[i % len(args.devices)]
+                                  for i in range(num_towers)]
+    return my_config
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report the scaling efficiency of data-parallel '
+                    'training with 1..N towers')
+    parser.add_argument('--train_filename', type=str, required=True,
+                        help='Dataset directory (FlyingChairs or UCF101)')
+    parser.add_argument('--batch_size', type=int, default=4,
+                        help='Batch size per tower')
+    parser.add_argument('--num_threads', type=int, default=6)
+    parser.add_argument('--num_scales', type=int, default=5)
+    parser.add_argument('--num_towers', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('--devices', type=str, nargs='+',
+                        default=['/cpu:0'],
+                        help='Devices the towers are assigned to round '
+                             'robin, e.g. /gpu:0 /gpu:1')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=10)
+    args = parser.parse_args()
+
+    baseline = None
+    for num_towers in args.num_towers:
+        net = MSOEmultiscale(
+            config=make_config(user_config(args, num_towers)))
+        it_per_sec = net.run_benchmark(args.iterations, args.warmup)
+        samples_per_sec = it_per_sec * args.batch_size * num_towers
+        if baseline is None:
+            baseline = samples_per_sec / num_towers
+        print '%d towers: %f iter/s, %f samples/s, efficiency %.1f%%' % \
+            (num_towers, it_per_sec, samples_per_sec,
+             100.0 * samples_per_sec / (num_towers * baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import argparse
+from src.MSOEmultiscale import MSOEmultiscale
+from src.utilities import parse_cpulist
+from benchmarks.common import make_config
+
+
+def user_config(args, feed_train_data):
+    my_config = {}
+    my_config['train_filename'] = args.train_filename
+    my_config['batch_size'] = args.batch_size
+    my_config['lr'] = 6e-3
+    my_config['num_threads'] = args.num_threads
+    my_config['num_scales'] = args.num_scales
+    my_config['gpu'] = args.gpu
+    my_config['feed_train_data'] = feed_train_data
+    if args.device is not None:
+        my_config['device'] = args.device
+    my_config['intra_op_threads'] = args.intra_op_threads
+    my_config['inter_op_threads'] = args.inter_op_threads
+    my_config['compute_cores'] = parse_cores(args.compute_cores)
+    my_config['loader_cores'] = parse_cores(args.loader_cores)
+    my_config['numa_node'] = args.numa_node
+    return my_config
+
+
+def parse_cores(cpulist):
+    return parse_cpulist(cpulist) if cpulist else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare training iterations/sec when the batch is fed '
+                    'through feed_dict vs. consumed directly from the queue')
+    parser.add_argument('--train_filename', type=str, required=True,
+                        help='Dataset directory (FlyingChairs or UCF101)')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_threads', type=int, default=6)
+    parser.add_argument('--num_scales', type=int, default=5)
+    parser.add_argument('--gpu', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--modes', type=str, nargs='+',
+                        default=['feed_dict', 'direct'],
+                        choices=['feed_dict', 'direct'])
+    parser.add_argument('--device', type=str, default=None,
+                        help='e.g. /cpu:0 (default /gpu:<gpu>)')
+    parser.add_argument('--intra_op_threads', type=int, default=None)
+    parser.add_argument('--inter_op_threads', type=int, default=None)
+    parser.add_argument('--compute_cores', type=str, default=None,
+                        help='Cores to run the model on, e.g. 0-15')
+    parser.add_argument('--loader_cores', type=str, default=None,
+                        help='Cores to run the data loaders on, e.g. 16-19')
+    parser.add_argument('--numa_node', type=int, default=None,
+                        help='Run the model on the cores of this node')
+    args = parser.parse_args()
+
+    results = {}
+    for mode in args.modes:
+        net = MSOEmultiscale(config=make_config(
+            user_config(args, mode == 'feed_dict')))
+        results[mode] = net.run_benchmark(args.iterations, args.warmup)
+        print '%-10s %f iter/s' % (mode, results[mode])
+
+    if len(results) == 2:
+        print 'speedup (direct vs. feed_dict): %.2fx' % \
+            (results['direct'] / results['feed_dict'])
+
+
+if __name__ == '__main__':
+    main()
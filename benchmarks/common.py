@@ -0,0 +1,20 @@
+import time
+import tensorflow as tf
+
+
+def time_run(sess, fetches, iterations, feed_dict=None):
+    """ Seconds per sess.run of fetches, after one warmup run """
+    sess.run(fetches, feed_dict=feed_dict)  # warmup
+    start = time.time()
+    for i in range(iterations):
+        sess.run(fetches, feed_dict=feed_dict)
+    return (time.time() - start) / iterations
+
+
+def make_config(user_config):
+    """ MSOEmultiscale config from user_config, with the test.py session """
+    config_proto = tf.ConfigProto()
+    config_proto.gpu_options.allow_growth = True
+    config_proto.allow_soft_placement = True
+    config_proto.log_device_placement = False
+    return {'tf': config_proto, 'user': user_config}
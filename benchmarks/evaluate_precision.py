@@ -0,0 +1,62 @@
+import argparse
+import tensorflow as tf
+from src.MSOEmultiscale import MSOEmultiscale
+from src.Dataset import load_dataset
+from src.evaluation import print_epe_comparison
+from benchmarks.common import make_config
+
+
+def user_config(args, precision):
+    my_config = {}
+    my_config['train'] = False
+    my_config['num_scales'] = args.num_scales
+    my_config['gpu'] = args.gpu
+    my_config['precision'] = precision
+    return my_config
+
+
+def evaluate_precision(args, dataset, checkpoint, precision):
+    """
+    Restores checkpoint into an inference-only pyramid computing in the
+    given precision and returns its validation EPE (overall, per speed
+    segment, segment pixel counts) and the seconds spent per batch
+    """
+    net = MSOEmultiscale(config=make_config(user_config(args, precision)))
+    with net.graph.as_default():
+        saver = tf.train.Saver()
+        with tf.Session(config=net.tf_config) as sess:
+            saver.restore(sess, checkpoint)
+            return net.evaluate(sess,
+                                dataset.validation_batches(args.batch_size))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report the validation EPE change of running the '
+                    'pyramid in reduced precision instead of float32')
+    parser.add_argument('--model_folder', type=str, required=True,
+                        help='Checkpoint folder to evaluate')
+    parser.add_argument('--train_filename', type=str, required=True,
+                        help='Dataset directory (FlyingChairs, UCF101 or '
+                             'shards)')
+    parser.add_argument('--precision', type=str, default='float16',
+                        choices=['float16'])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_scales', type=int, default=5)
+    parser.add_argument('--gpu', type=int, default=0)
+    args = parser.parse_args()
+
+    checkpoint = tf.train.latest_checkpoint(args.model_folder)
+    dataset = load_dataset(args.train_filename)
+
+    results = {}
+    for precision in ['float32', args.precision]:
+        results[precision] = evaluate_precision(args, dataset, checkpoint,
+                                                precision)
+
+    print_epe_comparison(results['float32'], results[args.precision],
+                         'float32', args.precision)
+
+
+if __name__ == '__main__':
+    main()
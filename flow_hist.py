@@ -72,25 +72,25 @@ def main(argv=None):
     flow_dirs = []
     flow_mags = []
     dataset = load_FlyingChairs('/home/mtesfald/Datasets/FlyingChairs/FlyingChairs_release/data')
-    images, flows = dataset.validation_data()
 
+    # stream the validation split instead of loading it all at once
     pair_count = 1
-    for flow in flows:
-        fx, fy = flow[:, :, 0], flow[:, :, 1]
-        v, ang = cv2.cartToPolar(fx, fy)
-        ang = ang[np.where(v > 0.1)]
-        v = v[v > 0.1]
-        tic = time.time()
-        flow_dirs.append(np.ravel(ang).tolist())
-        flow_mags.append(np.ravel(v).tolist())
-        toc = time.time()
-        print 'frame ' + str(pair_count) + ' time: ' + str(toc - tic)
-        pair_count += 1
+    for _, flows in dataset.validation_batches(64):
+        for flow in flows:
+            fx, fy = flow[:, :, 0], flow[:, :, 1]
+            v, ang = cv2.cartToPolar(fx, fy)
+            ang = ang[np.where(v > 0.1)]
+            v = v[v > 0.1]
+            tic = time.time()
+            flow_dirs.append(np.ravel(ang).tolist())
+            flow_mags.append(np.ravel(v).tolist())
+            toc = time.time()
+            print 'frame ' + str(pair_count) + ' time: ' + str(toc - tic)
+            pair_count += 1
 
     flow_dirs = list(itertools.chain.from_iterable(flow_dirs))
     flow_mags = list(itertools.chain.from_iterable(flow_mags))
-    print 'flows shape:'
-    print flows.shape
+    print str(pair_count - 1) + ' flows...'
     print str(len(flow_dirs)) + ' flow directions...'
     print str(len(flow_mags)) + ' flow magnitudes...'
     time.sleep(3)
@@ -0,0 +1,150 @@
+import os
+import glob
+import threading
+import Queue
+import cPickle
+import tensorflow as tf
+
+# suffix of the file holding the non-variable training state (e.g. the data
+# sampler's RNG) of a checkpoint
+STATE_SUFFIX = '.state'
+
+
+def load_training_state(checkpoint):
+    """ Training state saved with a checkpoint, None if there is none """
+    try:
+        with open(checkpoint + STATE_SUFFIX, 'rb') as f:
+            return cPickle.load(f)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+
+
+class CheckpointWriter(object):
+    """
+    This class writes checkpoints off the training thread. save() only
+        copies the variable values to host memory; a background thread
+        loads them into a shadow graph holding same-named variables and
+        serializes them with its own Saver, so the checkpoints restore into
+        the training graph as usual. Old checkpoints are deleted according
+        to the retention policy: the keep_last (at least 1) most recent ones
+        are kept, plus every one whose step is a multiple of keep_every.
+    """
+    def __init__(self, saver, variables, folder, prefix='iter', keep_last=5,
+                 keep_every=None):
+        self.variables = variables
+        self.folder = folder
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+
+        # training graph (with its saver_def) for the .meta of every
+        # checkpoint, so they can be re-imported, e.g. by freeze_graph
+        self.meta_graph = saver.export_meta_graph().SerializeToString()
+
+        # shadow graph, one host-side variable per training variable
+        self.graph = tf.Graph()
+        with self.graph.as_default(), tf.device('/cpu:0'):
+            self.placeholders = []
+            assign_ops = []
+            var_list = {}
+            for variable in variables:
+                name = variable.op.name
+                dtype = variable.dtype.base_dtype
+                shape = variable.get_shape()
+                shadow = tf.Variable(tf.zeros(shape, dtype), name=name,
+                                     trainable=False)
+                placeholder = tf.placeholder(dtype, shape)
+                assign_ops.append(tf.assign(shadow, placeholder))
+                self.placeholders.append(placeholder)
+                var_list[name] = shadow
+            self.assign_op = tf.group(*assign_ops)
+            self.saver = tf.train.Saver(var_list=var_list, max_to_keep=None,
+                                        pad_step_number=True)
+        self.sess = tf.Session(graph=self.graph)
+
+        # resume retention where a previous run left off
+        state = tf.train.get_checkpoint_state(folder)
+        self.checkpoints = list(state.all_model_checkpoint_paths) \
+            if state else []
+
+        # one snapshot in flight at a time bounds the extra host memory
+        self.snapshots = Queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._writer_main)
+        self.thread.daemon = True  # thread will close when parent quits
+        self.thread.start()
+
+    def save(self, sess, step, state=None):
+        """
+        Copy the variable values of sess to host memory and queue them for
+        writing, along with the picklable training state (waits only while
+        the previous snapshot is being written)
+        """
+        self._check_error()
+        values = sess.run(self.variables)
+        self.snapshots.put((step, values, state))
+
+    def close(self):
+        """ Write the queued snapshot and stop the writer thread """
+        self.snapshots.put(None)
+        self.thread.join()
+        self.sess.close()
+        self._check_error()
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _writer_main(self):
+        while True:
+            snapshot = self.snapshots.get()
+            if snapshot is None:
+                return
+            try:
+                self._write(*snapshot)
+            except Exception as e:
+                # re-raised on the training thread by the next save/close
+                self.error = e
+
+    def _write(self, step, values, state):
+        try:
+            os.makedirs(self.folder)
+        except OSError:
+            if not os.path.isdir(self.folder):
+                raise
+
+        self.sess.run(self.assign_op,
+                      feed_dict=dict(zip(self.placeholders, values)))
+        path = self.saver.save(self.sess,
+                               os.path.join(self.folder, self.prefix),
+                               global_step=step, write_meta_graph=False,
+                               write_state=False)
+        with open(path + '.meta', 'wb') as f:
+            f.write(self.meta_graph)
+        if state is not None:
+            with open(path + STATE_SUFFIX, 'wb') as f:
+                cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+
+        # retention policy
+        if path in self.checkpoints:
+            self.checkpoints.remove(path)
+        self.checkpoints.append(path)
+        # the newest checkpoint is always kept, the state file points at it
+        recent = self.checkpoints[-max(self.keep_last or 0, 1):]
+        kept = []
+        for checkpoint in self.checkpoints:
+            if checkpoint in recent or self._keep_forever(checkpoint):
+                kept.append(checkpoint)
+            else:
+                for filename in glob.glob(checkpoint + '.*'):
+                    os.remove(filename)
+        self.checkpoints = kept
+        tf.train.update_checkpoint_state(
+            self.folder, path, all_model_checkpoint_paths=self.checkpoints)
+
+    def _keep_forever(self, checkpoint):
+        if not self.keep_every:
+            return False
+        step = int(checkpoint.rsplit('-', 1)[1])
+        return step % self.keep_every == 0
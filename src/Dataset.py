@@ -1,8 +1,21 @@
 import os
+import json
+import hashlib
 import numpy as np
 from src.utilities import *
 import glob
 
+# name of the index file describing a directory of pre-packed shards
+SHARD_INDEX = 'index.json'
+
+# where persisted sequence manifests live (kept out of the dataset tree so
+# that writing one doesn't change the directory mtimes it is keyed by)
+MANIFEST_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'msoenet')
+MANIFEST_VERSION = 1
+
+# exact (cos, sin) of k quarter turns
+QUARTER_TURNS = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+
 
 class DataSet(object):
 
@@ -12,84 +25,188 @@ class DataSet(object):
         self._validation = validation
         self._epochs_completed = 0
         self._index_in_epoch = 0
+        self._crop_size = None
+        self._patches_per_sample = 1
 
-    def validation_data(self):
-        packaged_images = []
-        packaged_flows = []
-        for sequence in self._validation:
-            # getting file paths
-            img_names = sequence['image_names']
-            flow_name = sequence['flow_name']
-            prefix = sequence['prefix'] + '/'
+    @property
+    def num_validation(self):
+        return len(self._validation)
+
+    def get_state(self):
+        """
+        Sampling state (numpy RNG and epoch counters) of this process to be
+        stored alongside a checkpoint; it does not cover the RNGs of
+        ProcessLoader workers
+        """
+        return {'numpy_rng': np.random.get_state(),
+                'epochs_completed': self._epochs_completed,
+                'index_in_epoch': self._index_in_epoch}
+
+    def set_state(self, state):
+        """ Restore the sampling state returned by get_state """
+        np.random.set_state(state['numpy_rng'])
+        self._epochs_completed = state['epochs_completed']
+        self._index_in_epoch = state['index_in_epoch']
+
+    def set_crop(self, crop_size, patches_per_sample=1):
+        """
+        Make next_batch return random crop_size (height, width) patches of
+        the training samples, patches_per_sample of them from every loaded
+        sample (None for full frames). Validation data is not cropped.
+        """
+        self._crop_size = tuple(crop_size) if crop_size else None
+        self._patches_per_sample = patches_per_sample
+
+    def sample_shapes(self):
+        """
+        Returns the (input, target) shapes of a single training sample, read
+        from the first validation (or training) sequence only
+        """
+        sequences = self._validation or self._train
+        images, flow = self._load_sample(sequences[0])
+        return self._cropped_shapes(list(images.shape), list(flow.shape))
 
+    def _cropped_shapes(self, input_shape, target_shape):
+        if self._crop_size is not None:
+            input_shape[1:3] = self._crop_size
+            target_shape[0:2] = self._crop_size
+        return input_shape, target_shape
+
+    def _sample_size(self, sequence):
+        # (height, width) recorded in the manifest, else from the .flo header
+        if 'shape' in sequence:
+            return tuple(sequence['shape'])
+        return readFlowShape(sequence['prefix'] + '/' + sequence['flow_name'])
+
+    def _load_sample(self, sequence, region=None):
+        """
+        Loads the frames and flow of sequence, only their (y, x, height,
+        width) region if given
+        """
+        # getting file paths
+        img_names = sequence['image_names']
+        flow_name = sequence['flow_name']
+        prefix = sequence['prefix'] + '/'
+
+        if region is None:
             # Read images in sequence and stack them into a single volume
             images = np.stack([load_image(prefix + name)
                                for name in img_names])
 
             # Read flo file
             flow = readFlowFile(prefix + flow_name)
-            flow[:, :, 1] *= -1  # fy is in opposite direction, must flip
-                                 # EpicFlow problems.
+        else:
+            images = np.stack([load_image_crop(prefix + name, *region)
+                               for name in img_names])
+            flow = readFlowCrop(prefix + flow_name, *region)
+        flow[:, :, 1] *= -1  # fy is in opposite direction, must flip
+                             # EpicFlow problems.
 
-            # package images as data points and provide the ground truth flow
-            packaged_images.append(images)
-            packaged_flows.append(flow)
+        return images, flow
 
-        # wrap in numpy array (easier to work with)
-        packaged_images = np.array(packaged_images)
-        packaged_flows = np.array(packaged_flows)
+    def validation_batches(self, batch_size, prefetch_batches=2):
+        """
+        Lazily yields the validation split in (input, target) chunks of at
+        most batch_size samples, decoding ahead on a background thread
+        """
+        def chunks():
+            for start in range(0, len(self._validation), batch_size):
+                samples = [self._load_sample(sequence) for sequence in
+                           self._validation[start:start + batch_size]]
+                yield np.array([images for images, _ in samples]), \
+                    np.array([flow for _, flow in samples])
 
-        return packaged_images, packaged_flows
+        return prefetch(chunks(), prefetch_batches)
 
-    def discrete_rotate(self, input, k, flow=False):
-        if flow:
-            rad = k * (np.pi / 2.0)
-            fx, fy = np.copy(input[:, :, 0]), np.copy(input[:, :, 1])
-            sin = np.sin(rad)
-            cos = np.cos(rad)
-            input[..., 0] = (fx * cos) - (fy * sin)
-            input[..., 1] = (fx * sin) + (fy * cos)
-        return np.rot90(input, k)
+    def discrete_rotate(self, input, k, flow=False, axes=(0, 1)):
+        """
+        Rotates input by k quarter turns in the plane of axes. For flows
+        (fx, fy in the last axis) the vectors are rotated as well.
+        """
+        output = np.rot90(input, k, axes=axes)
+        if flow and k % 4:
+            cos, sin = QUARTER_TURNS[k % 4]
+            fx, fy = output[..., 0], output[..., 1]
+            output = np.stack([(fx * cos) - (fy * sin),
+                               (fx * sin) + (fy * cos)], axis=-1)
+        return output
 
     def augment(self, dataX, dataY):
-        for i in range(dataX.shape[0]):
-            k = np.random.randint(0, 4)
-            if k > 0:
-                for j in range(dataX.shape[1]):
-                    dataX[i][j] = self.discrete_rotate(dataX[i][j], k)
-                dataY[i] = self.discrete_rotate(dataY[i], k, flow=True)
+        """
+        Rotates every sample of the batch (in place) by a random number of
+        quarter turns, rotating all the samples sharing a rotation at once.
+        Non-square frames are only rotated by 0 or 180 degrees so that the
+        batch keeps its shape.
+        """
+        height, width = dataY.shape[1:3]
+        if height == width:
+            ks = np.random.randint(0, 4, len(dataX))
+        else:
+            ks = 2 * np.random.randint(0, 2, len(dataX))
+
+        for k in range(1, 4):
+            indices = np.flatnonzero(ks == k)
+            if len(indices) == 0:
+                continue
+            dataX[indices] = self.discrete_rotate(dataX[indices], k,
+                                                  axes=(2, 3))
+            dataY[indices] = self.discrete_rotate(dataY[indices], k,
+                                                  flow=True, axes=(1, 2))
         return dataX, dataY
 
-    # TODO: reduce code reuse between this and validation_data
+    def random_patches(self, sequence):
+        """
+        Returns patches_per_sample random crops of sequence as (images, flow)
+        pairs, loading only the region spanned by them
+        """
+        crop_height, crop_width = self._crop_size
+        height, width = self._sample_size(sequence)
+        if crop_height > height or crop_width > width:
+            raise ValueError('random_patches: crop size %s exceeds sample '
+                             'size %s' % (self._crop_size, (height, width)))
+
+        ys = np.random.randint(0, height - crop_height + 1,
+                               self._patches_per_sample)
+        xs = np.random.randint(0, width - crop_width + 1,
+                               self._patches_per_sample)
+        top, left = int(ys.min()), int(xs.min())
+        images, flow = self._load_sample(
+            sequence, (top, left, int(ys.max()) - top + crop_height,
+                       int(xs.max()) - left + crop_width))
+
+        patches = []
+        for y, x in zip(ys - top, xs - left):
+            patches.append((images[:, y:y + crop_height, x:x + crop_width],
+                            flow[y:y + crop_height, x:x + crop_width]))
+        return patches
+
     def next_batch(self, batch_size, augment_batch=False):
-        # sampling with replacement
-        indices = np.random.choice(len(self._train), batch_size)
+        # sampling with replacement (when cropping, every loaded sample
+        # provides patches_per_sample patches of the batch)
+        num_samples = batch_size
+        if self._crop_size is not None:
+            num_samples = -(-batch_size // self._patches_per_sample)
+        indices = np.random.choice(len(self._train), num_samples)
         sequences = [self._train[i] for i in indices]
 
         packaged_images = []
         packaged_flows = []
         for sequence in sequences:
-            # getting file paths
-            img_names = sequence['image_names']
-            flow_name = sequence['flow_name']
-            prefix = sequence['prefix'] + '/'
-
-            # Read images in sequence and stack them into a single volume
-            images = np.stack([load_image(prefix + name)
-                               for name in img_names])
-
-            # Read flo file
-            flow = readFlowFile(prefix + flow_name)
-            flow[:, :, 1] *= -1  # fy is in opposite direction, must flip
-                                 # EpicFlow problems.
+            if self._crop_size is None:
+                patches = [self._load_sample(sequence)]
+            else:
+                patches = self.random_patches(sequence)
 
             # package images as data points and provide the ground truth flow
-            packaged_images.append(images)
-            packaged_flows.append(flow)
+            for images, flow in patches:
+                packaged_images.append(images)
+                packaged_flows.append(flow)
+        packaged_images = packaged_images[:batch_size]
+        packaged_flows = packaged_flows[:batch_size]
 
         # update epoch count
-        assert batch_size <= self._num_examples
-        self._index_in_epoch += batch_size
+        assert num_samples <= self._num_examples
+        self._index_in_epoch += num_samples
         if self._index_in_epoch > self._num_examples:
             self._epochs_completed += 1
             # start next epoch
@@ -105,7 +222,146 @@ class DataSet(object):
         return packaged_images, packaged_flows
 
 
-def load_FlyingChairs(data_dir):
+class ShardedDataSet(DataSet):
+    """
+    DataSet served from pre-packed, fixed-stride binary shards (see
+    src/pack_shards.py). Samples are sliced out of np.memmap views, so
+    nothing is decoded at training time.
+    """
+
+    def __init__(self, shard_dir):
+        with open(os.path.join(shard_dir, SHARD_INDEX), 'r') as f:
+            self.index = json.load(f)
+
+        self.input_shape = tuple(self.index['input_shape'])
+        self.target_shape = tuple(self.index['target_shape'])
+        self.shard_size = self.index['shard_size']
+        frame_dtype = np.dtype(self.index['frame_dtype'])
+        flow_dtype = np.dtype(self.index['flow_dtype'])
+
+        # map every shard of every split (read-only, paged in on demand)
+        self._frames = {}
+        self._flows = {}
+        samples = {}
+        for split, info in self.index['splits'].items():
+            self._frames[split] = []
+            self._flows[split] = []
+            for shard in info['shards']:
+                prefix = os.path.join(shard_dir, shard['name'])
+                self._frames[split].append(
+                    np.memmap(prefix + '.frames', dtype=frame_dtype,
+                              mode='r',
+                              shape=(shard['count'],) + self.input_shape))
+                self._flows[split].append(
+                    np.memmap(prefix + '.flows', dtype=flow_dtype,
+                              mode='r',
+                              shape=(shard['count'],) + self.target_shape))
+            samples[split] = [(split, i) for i in range(info['count'])]
+
+        super(ShardedDataSet, self).__init__(train=samples['train'],
+                                             validation=samples['validation'])
+
+    def sample_shapes(self):
+        return self._cropped_shapes(list(self.input_shape),
+                                    list(self.target_shape))
+
+    def _sample_size(self, sample):
+        return self.target_shape[:2]
+
+    def _load_sample(self, sample, region=None):
+        split, i = sample
+        shard, offset = divmod(i, self.shard_size)
+        images = self._frames[split][shard][offset]
+        flow = self._flows[split][shard][offset]
+
+        # slicing the memmap pages in the region only
+        if region is not None:
+            y, x, height, width = region
+            images = images[:, y:y + height, x:x + width]
+            flow = flow[y:y + height, x:x + width]
+
+        # uint8 frames were quantized from the [0, 1] grayscale range
+        if images.dtype == np.uint8:
+            images = images.astype('float32') / 255.0
+        else:
+            images = images.astype('float32')
+
+        return images, flow.astype('float32')
+
+
+def tree_signature(paths):
+    return [[path, os.stat(path).st_mtime] for path in paths]
+
+
+def cached_manifest(data_dir, signature_paths, index_fn,
+                    manifest_dir=MANIFEST_DIR):
+    """
+    Returns the (train, validation) sequence lists of data_dir, reusing the
+    manifest persisted by a previous start if the mtimes of signature_paths
+    haven't changed, otherwise rebuilding it with index_fn(data_dir)
+    """
+    data_dir = os.path.abspath(data_dir)
+    signature = tree_signature(signature_paths)
+    manifest_path = None
+    if manifest_dir is not None:
+        manifest_path = os.path.join(manifest_dir,
+                                     hashlib.md5(data_dir).hexdigest() +
+                                     '.json')
+
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest['version'] == MANIFEST_VERSION and \
+                    manifest['data_dir'] == data_dir and \
+                    manifest['signature'] == signature:
+                print 'Reusing dataset manifest ' + manifest_path
+                return manifest['train'], manifest['validation']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    train_sequences, validation_sequences = index_fn(data_dir)
+
+    # record per-sample shapes (only the .flo header is read)
+    for sequence in train_sequences + validation_sequences:
+        sequence['shape'] = list(readFlowShape(sequence['prefix'] + '/' +
+                                               sequence['flow_name']))
+
+    if manifest_path is not None:
+        manifest = {'version': MANIFEST_VERSION,
+                    'data_dir': data_dir,
+                    'signature': signature,
+                    'train': train_sequences,
+                    'validation': validation_sequences}
+        try:
+            try:
+                os.makedirs(manifest_dir)
+            except OSError:
+                if not os.path.isdir(manifest_dir):
+                    raise
+
+            # write then rename, so concurrent workers never read a
+            # partial manifest
+            tmp_path = '%s.%d.tmp' % (manifest_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tmp_path, manifest_path)
+        except (IOError, OSError) as e:
+            print 'Could not write dataset manifest (%s)' % e
+
+    return train_sequences, validation_sequences
+
+
+def load_FlyingChairs(data_dir, manifest_dir=MANIFEST_DIR):
+    split_filepath = os.path.split(data_dir)[0] + '/FlyingChairs_train_val.txt'
+    train_sequences, validation_sequences = \
+        cached_manifest(data_dir, [data_dir, split_filepath],
+                        _index_FlyingChairs, manifest_dir)
+
+    return DataSet(train=train_sequences,
+                   validation=validation_sequences)
+
+
+def _index_FlyingChairs(data_dir):
     train_sequences = []
     validation_sequences = []
 
@@ -150,10 +406,25 @@ def load_FlyingChairs(data_dir):
                 })
         count += 3
 
+    return train_sequences, validation_sequences
+
+
+def load_UCF101(data_dir, manifest_dir=MANIFEST_DIR):
+    # adding or removing clips changes the group directory mtimes, adding or
+    # removing frames (and flows) those of the clip directories
+    groups = get_immediate_subdirectories(data_dir)
+    signature_paths = [data_dir] + groups
+    for group in groups:
+        signature_paths += get_immediate_subdirectories(group)
+    train_sequences, validation_sequences = \
+        cached_manifest(data_dir, signature_paths, _index_UCF101,
+                        manifest_dir)
+
     return DataSet(train=train_sequences,
                    validation=validation_sequences)
 
-def load_UCF101(data_dir):
+
+def _index_UCF101(data_dir):
     train_sequences = []
     validation_sequences = []
 
@@ -184,5 +455,19 @@ def load_UCF101(data_dir):
                 count += 1
             i += 1
 
-    return DataSet(train=train_sequences,
-                   validation=validation_sequences)
+    return train_sequences, validation_sequences
+
+
+def load_shards(shard_dir):
+    print 'Mapping dataset shards...'
+    return ShardedDataSet(shard_dir)
+
+
+def load_dataset(data_dir):
+    if os.path.isfile(os.path.join(data_dir, SHARD_INDEX)):
+        return load_shards(data_dir)
+    elif 'UCF' in data_dir:
+        return load_UCF101(data_dir)
+    elif 'Chairs' in data_dir:
+        return load_FlyingChairs(data_dir)
+    raise ValueError('load_dataset: unknown dataset %s' % data_dir)
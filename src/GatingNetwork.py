@@ -4,15 +4,17 @@ from src.graph_components import *
 
 class GatingNetwork(object):
 
-    def __init__(self, name, input, reuse=None):
+    def __init__(self, name, input, reuse=None, conv1=None, num_output=None):
         self.name = name
 
         with tf.get_default_graph().name_scope(self.name):
             """
-            Construct the gating network graph structure
+            Construct the gating network graph structure (conv1 can be passed
+            in precomputed, in which case num_output replaces input)
             """
-            # first convolution (1x3x3x1x4)
-            conv1 = conv3d('Gate_conv1', input[:, :1], 3, 1, 4, reuse)
+            if conv1 is None:
+                # first convolution (1x3x3x1x4)
+                conv1 = conv3d('Gate_conv1', input[:, :1], 3, 1, 4, reuse)
             # first activation
             h_conv1 = relu(conv1)
             # second convolution (1x3x3x1x8)
@@ -20,7 +22,8 @@ class GatingNetwork(object):
             # second activation
             h_conv2 = relu(conv2)
             # decode to final gate output (1x1x1x1xnum_input_channels)
-            num_output = input.get_shape().as_list()[-1]
+            if num_output is None:
+                num_output = input.get_shape().as_list()[-1]
             gate_output = conv3d('Gate_conv3', h_conv2, 1, 1, num_output,
                                  reuse)
             # final activation [0,1]
@@ -0,0 +1,492 @@
+import os
+import glob
+import collections
+import cv2
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import tensor_util
+from src.utilities import load_graph, rgb2gray, prefetch, writeFlowFile, \
+    draw_hsv
+from src.graph_components import blur_downsample3d, upconv3d, conv3d, \
+    reshape
+from src.MSOEnet import MSOEnet
+from src.GatingNetwork import GatingNetwork
+
+# variable scopes holding the MSOEmultiscale weights
+MODEL_SCOPES = ['MSOEnet_conv1', 'MSOEnet_conv2', 'MSOEnet_conv3',
+                'Gate_conv1', 'Gate_conv2', 'Gate_conv3', 'conv3d']
+
+
+def read_frames(source):
+    """
+    Yields the frames (BGR, uint8) of a video file, of every image in a
+    directory or of every image matching a glob pattern, in sorted order
+    """
+    if os.path.isfile(source):
+        capture = cv2.VideoCapture(source)
+        if not capture.isOpened():
+            raise ValueError('read_frames: could not open video %s' % source)
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                yield frame
+        finally:
+            capture.release()
+    else:
+        if os.path.isdir(source):
+            paths = [path for path in sorted(glob.glob(source + '/*'))
+                     if os.path.splitext(path)[1].lower() in
+                     ('.png', '.jpg', '.jpeg', '.ppm', '.bmp')]
+        else:
+            paths = sorted(glob.glob(source))
+        if not paths:
+            raise ValueError('read_frames: no frames found in %s' % source)
+        for path in paths:
+            yield cv2.imread(path, cv2.IMREAD_COLOR)
+
+
+def load_weights(model):
+    """
+    Returns {variable name: value} of the MSOEmultiscale weights stored in a
+    frozen graph file or in a checkpoint (prefix or folder). Frozen graphs
+    must be float32 exports: the optimized reduced-precision ones fold the
+    weight casts, which removes the <scope>/weights constants.
+    """
+    names = [scope + '/' + variable for scope in MODEL_SCOPES
+             for variable in ('weights', 'biases')]
+
+    if os.path.isfile(model):
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(model, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        values = dict((node.name, node.attr['value'].tensor)
+                      for node in graph_def.node if node.op == 'Const')
+        missing = [name for name in names if name not in values]
+        if missing:
+            raise ValueError('load_weights: %s has no constants %s (use '
+                             'the checkpoint or a float32 export)' %
+                             (model, ', '.join(missing)))
+        return dict((name, tensor_util.MakeNdarray(values[name]))
+                    for name in names)
+
+    if os.path.isdir(model):
+        model = tf.train.latest_checkpoint(model)
+    reader = tf.train.NewCheckpointReader(model)
+    return dict((name, reader.get_tensor(name)) for name in names)
+
+
+def receptive_field_radius(num_scales):
+    """
+    Radius (in full resolution pixels) of the region of the input frames an
+    output flow pixel of the MSOEmultiscale pyramid depends on
+    """
+    radius = 0
+    for scale in range(num_scales):
+        # 5x5 blur before every downsampling to reach this scale
+        blur = sum(2 * 2**(s - 1) for s in range(1, scale + 1))
+        # MSOEnet: 11x11 conv1 followed by 5x5 avg pooling (conv2 is 1x1)
+        msoe = (5 + 2) * 2**scale
+        # upconv back to full resolution: bilinear upsampling from the
+        # coarser scale followed by a 3x3 conv (the gate is narrower)
+        up = sum(2**(s + 1) + 2**s for s in range(scale))
+        radius = max(radius, blur + msoe + up)
+    return radius
+
+
+def tile_spans(length, tile_size, margin, align=1):
+    """
+    Splits [0, length) into cores evaluated with tiles of tile_size that
+    extend at least margin past their core (or up to the frame border).
+    With tile_size and margin multiples of align, the tile origins are too
+    (the last one whenever length is a multiple of align as well).
+    Returns (tile origin, tile size, core start, core end) tuples.
+    """
+    if length <= tile_size:
+        return [(0, length, 0, length)]
+    core = tile_size - 2 * margin
+    if core <= 0:
+        raise ValueError('tile_spans: tile size %d leaves no core with a '
+                         'margin of %d' % (tile_size, margin))
+    spans = []
+    start = 0
+    while start < length:
+        end = min(start + core, length)
+        # the last tile ends at the frame border, on the grid if possible
+        last = (length - tile_size) // align * align
+        if last + tile_size < length:
+            last = length - tile_size
+        origin = min(max(start - margin, 0), last)
+        spans.append((origin, tile_size, start, end))
+        start = end
+    return spans
+
+
+def preprocess_frame(frame):
+    """ BGR uint8 -> grayscale [0, 1] (h x w x 1), same as load_image """
+    gray = rgb2gray(frame[..., ::-1]).astype('float32') / 255.0
+    return np.expand_dims(gray, 2)
+
+
+class InferenceEngine(object):
+    """
+    Runs a frozen MSOEmultiscale graph (see src/freeze_graph.py) over long
+        frame sequences. The graph is loaded once into a persistent session,
+        frame pairs are decoded ahead on a background thread and evaluated in
+        batches, and flows are handed out (or written) as soon as they are
+        computed, so memory is bounded by the batch size rather than the
+        length of the footage.
+
+    With tile_size set, frames are split into overlapping tiles (batched by
+        tile_batch_size) whose overlap covers the receptive field of the
+        pyramid, and only the tile cores are kept, so peak memory is bounded
+        by the tile size rather than the frame size. tile_size is rounded up
+        to a multiple of 2**(num_scales-1) so that every tile starts on the
+        grid of the coarsest scale. Tiles are normalized with the moments of
+        the whole frame pair, so the stitched flow matches the untiled one
+        (exactly when the frame size is a multiple of 2**(num_scales-1)).
+    """
+    def __init__(self, frozen_graph, batch_size=8, config=None,
+                 input_name='input:0',
+                 output_name='MSOEmultiscale/reshape/Reshape:0',
+                 prefetch_batches=2, tile_size=None, tile_batch_size=None,
+                 mean_name='MSOEmultiscale/input_mean:0',
+                 var_name='MSOEmultiscale/input_var:0'):
+        self.batch_size = batch_size
+        self.prefetch_batches = prefetch_batches
+
+        self.graph = load_graph(frozen_graph, name='')
+        self.input = self.graph.get_tensor_by_name(input_name)
+        self.output = self.graph.get_tensor_by_name(output_name)
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+        self.tile_size = None
+        if tile_size:
+            try:
+                self.input_mean = self.graph.get_tensor_by_name(mean_name)
+                self.input_var = self.graph.get_tensor_by_name(var_name)
+            except KeyError:
+                raise ValueError('InferenceEngine: %s has no feedable '
+                                 'contrast_norm moments, re-export it to use '
+                                 'tiling' % frozen_graph)
+            self.tile_batch_size = tile_batch_size or batch_size
+
+            # overlap covering the receptive field, rounded to the coarsest
+            # scale so that tiles downsample like the full frame
+            scopes = set(op.name.split('/')[1]
+                         for op in self.graph.get_operations()
+                         if op.name.startswith('MSOEmultiscale/MSOEnet_'))
+            num_scales = 1 + max(int(scope[len('MSOEnet_'):])
+                                 for scope in scopes
+                                 if scope[len('MSOEnet_'):].isdigit())
+            align = 2**(num_scales - 1)
+            radius = receptive_field_radius(num_scales)
+            self.tile_margin = -(-radius // align) * align
+            # tiles must start on the grid of the coarsest scale too
+            self.tile_size = -(-tile_size // align) * align
+            self.tile_align = align
+            if self.tile_size != tile_size:
+                print 'InferenceEngine: tile size rounded up to %d (a ' \
+                    'multiple of %d)' % (self.tile_size, align)
+
+    def close(self):
+        self.sess.close()
+
+    def _pair_batches(self, source):
+        """
+        Groups consecutive frame pairs (t, t+1) into batches of
+        batch_size x 2 x h x w x 1, yielding (frame indices, batch)
+        """
+        indices = []
+        pairs = []
+        previous = None
+        for t, frame in enumerate(read_frames(source)):
+            frame = preprocess_frame(frame)
+            if previous is not None:
+                indices.append(t - 1)
+                pairs.append(np.stack([previous, frame]))
+                if len(pairs) == self.batch_size:
+                    yield indices, np.array(pairs)
+                    indices = []
+                    pairs = []
+            previous = frame
+
+        # evaluate the rest (if there are any)
+        if pairs:
+            yield indices, np.array(pairs)
+
+    def flows(self, source):
+        """
+        Yields (t, flow) for every frame pair (t, t+1) of source. Flows are
+        h x w x 2 with fy pointing up, like the training targets.
+        """
+        for indices, batch in prefetch(self._pair_batches(source),
+                                       self.prefetch_batches):
+            if self.tile_size:
+                results = self._run_tiled(batch)
+            else:
+                results = self.sess.run(self.output,
+                                        feed_dict={self.input: batch})
+            for t, flow in zip(indices, results):
+                yield t, flow
+
+    def _run_tiled(self, batch):
+        num_pairs, _, height, width, _ = batch.shape
+
+        # contrast_norm moments of the whole frame pairs
+        flat = batch.reshape(num_pairs, -1)
+        mean = flat.mean(axis=1).reshape(num_pairs, 1, 1, 1, 1)
+        var = flat.var(axis=1).reshape(num_pairs, 1, 1, 1, 1)
+
+        tiles = [(i, y, x) for i in range(num_pairs)
+                 for y in tile_spans(height, self.tile_size, self.tile_margin,
+                                     self.tile_align)
+                 for x in tile_spans(width, self.tile_size, self.tile_margin,
+                                     self.tile_align)]
+
+        flows = np.zeros((num_pairs, height, width, 2), np.float32)
+        for start in range(0, len(tiles), self.tile_batch_size):
+            chunk = tiles[start:start + self.tile_batch_size]
+            pairs = [i for i, _, _ in chunk]
+            inputs = np.array([batch[i, :, y[0]:y[0] + y[1], x[0]:x[0] + x[1]]
+                               for i, y, x in chunk])
+            results = self.sess.run(self.output,
+                                    feed_dict={self.input: inputs,
+                                               self.input_mean: mean[pairs],
+                                               self.input_var: var[pairs]})
+
+            # keep the tile cores only
+            for (i, y, x), result in zip(chunk, results):
+                flows[i, y[2]:y[3], x[2]:x[3]] = \
+                    result[y[2] - y[0]:y[3] - y[0], x[2] - x[0]:x[3] - x[0]]
+        return flows
+
+    def run(self, source, output_dir, write_flo=True,
+            write_visualization=False):
+        """
+        Computes the flows of source and writes them to output_dir as they
+        come in (flow_%08d.flo in the Middlebury convention, i.e. fy pointing
+        down, and/or img_%08d.jpeg visualizations). Returns the number of
+        flows written.
+        """
+        try:
+            os.makedirs(output_dir)
+        except OSError:
+            if not os.path.isdir(output_dir):
+                raise
+
+        count = 0
+        for t, flow in self.flows(source):
+            if write_flo:
+                flo = np.copy(flow)
+                flo[:, :, 1] *= -1  # back to fy pointing down
+                writeFlowFile(os.path.join(output_dir,
+                                           'flow_%08d.flo' % t), flo)
+            if write_visualization:
+                cv2.imwrite(os.path.join(output_dir, 'img_%08d.jpeg' % t),
+                            draw_hsv(flow))
+            count += 1
+        return count
+
+
+def frame_conv3d(name, input_layer, weights):
+    """
+    Bias-free, spatially SYMMETRIC padded convolution of a single frame with
+    constant weights (same padding as conv3d)
+    """
+    with tf.get_default_graph().name_scope(name):
+        pad = weights.shape[1] / 2
+        input_layer = tf.pad(input_layer,
+                             [[0, 0], [0, 0], [pad, pad], [pad, pad],
+                              [0, 0]], 'SYMMETRIC')
+        return tf.nn.conv3d(input_layer, tf.constant(weights),
+                            strides=[1, 1, 1, 1, 1], padding='VALID')
+
+
+class StreamingInferenceEngine(InferenceEngine):
+    """
+    Sequential-video variant of InferenceEngine. Everything that depends on a
+        single frame (the blurred/downsampled pyramid levels, both temporal
+        taps of MSOEnet_conv1, Gate_conv1 on the first frame of a pair and
+        the frame moments) is computed once per frame and cached in a ring
+        buffer keyed by frame index, so frame t+1 of pair (t, t+1) is reused
+        by pair (t+1, t+2). contrast_norm normalizes every pair jointly, but
+        the pyramid and those convolutions are linear and the blur kernel sums
+        to one, so the normalization is applied afterwards from the cached
+        moments, giving the same flows as the MSOEmultiscale graph. model is
+        a checkpoint or a float32 frozen graph (see load_weights).
+    """
+    def __init__(self, model, num_scales, batch_size=8, config=None,
+                 prefetch_batches=2, cache_size=2, eps=1e-12):
+        self.num_scales = num_scales
+        self.batch_size = batch_size  # new frames per run
+        self.prefetch_batches = prefetch_batches
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+        weights = load_weights(model)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self._build(weights, eps)
+            self.sess = tf.Session(graph=self.graph, config=config)
+            self.sess.run(tf.global_variables_initializer())
+
+    def _build(self, weights, eps):
+        num_scales = self.num_scales
+
+        # model variables, initialized from the trained weights so that the
+        # regular graph components can reuse them
+        for name, value in weights.items():
+            scope, variable = name.split('/')
+            with tf.variable_scope(scope):
+                tf.get_variable(variable, initializer=tf.constant(value))
+
+        W_conv1 = weights['MSOEnet_conv1/weights']  # 2x11x11x1x32
+        gW_conv1 = weights['Gate_conv1/weights']  # 1x3x3x1x4
+
+        """
+        Per-frame stage (new frames only)
+        """
+        self.frames = tf.placeholder(dtype=tf.float32,
+                                     shape=[None, None, None, 1],
+                                     name='frames')
+        levels = [tf.expand_dims(self.frames, 1)]
+        for scale in range(1, num_scales):
+            levels.append(blur_downsample3d('input_downsample_' + str(scale),
+                                            levels[-1], 5, 2, sigma=2))
+
+        new = {'sum': tf.reduce_sum(levels[0], [1, 2, 3, 4]),
+               'sum_squares': tf.reduce_sum(tf.square(levels[0]),
+                                            [1, 2, 3, 4])}
+        for scale in range(num_scales):
+            new['msoe_tap0_%d' % scale] = \
+                frame_conv3d('msoe_tap0', levels[scale], W_conv1[:1])
+            new['msoe_tap1_%d' % scale] = \
+                frame_conv3d('msoe_tap1', levels[scale], W_conv1[1:])
+            new['gate_%d' % scale] = \
+                frame_conv3d('gate_conv1', levels[scale], gW_conv1)
+
+        """
+        Pair stage (cached previous frame followed by the new frames)
+        """
+        self.previous = {}
+        first = {}
+        for key in ['sum', 'sum_squares']:
+            self.previous[key] = tf.placeholder(dtype=tf.float32,
+                                                shape=[None])
+        for scale in range(num_scales):
+            for key, channels in [('msoe_tap0_%d' % scale, 32),
+                                  ('gate_%d' % scale, 4)]:
+                self.previous[key] = \
+                    tf.placeholder(dtype=tf.float32,
+                                   shape=[None, 1, None, None, channels])
+        self.last = {}
+        for key, previous in self.previous.items():
+            frames = tf.concat([previous, new[key]], axis=0)
+            first[key] = frames[:-1]
+            self.last[key] = frames[-1:]  # cached for the next run
+        num_pairs = tf.shape(first['sum'])[0]
+        num_new = tf.shape(self.frames)[0]
+        second = dict((key, value[num_new - num_pairs:])
+                      for key, value in new.items())
+
+        # contrast_norm moments of every pair
+        count = 2.0 * tf.to_float(tf.shape(self.frames)[1] *
+                                  tf.shape(self.frames)[2])
+        mean = (first['sum'] + second['sum']) / count
+        var = (first['sum_squares'] + second['sum_squares']) / count - \
+            tf.square(mean)
+        mean = tf.reshape(mean, [-1, 1, 1, 1, 1])
+        std = tf.reshape(tf.sqrt(tf.maximum(var, 0.0) + eps),
+                         [-1, 1, 1, 1, 1])
+
+        W_conv1_sum = W_conv1.sum(axis=(0, 1, 2, 3))
+        gW_conv1_sum = gW_conv1.sum(axis=(0, 1, 2, 3))
+
+        def msoe(scale):
+            conv1 = (first['msoe_tap0_%d' % scale] +
+                     second['msoe_tap1_%d' % scale] -
+                     mean * W_conv1_sum) / std + \
+                weights['MSOEnet_conv1/biases']
+            return MSOEnet('MSOEnet_' + str(scale), None, reuse=True,
+                           conv1=conv1).output
+
+        # MSOEnet pyramid (small to big), as in MSOEmultiscale.build_pyramid
+        msoes = [None]*num_scales
+        msoes[num_scales-1] = msoe(num_scales-1)
+        for scale in range(num_scales-2, -1, -1):
+            msoe_scale = msoe(scale)
+            up_msoe = upconv3d('upconv', msoes[scale+1], 3,
+                               tf.shape(msoe_scale)[2:4],
+                               msoe_scale.get_shape().as_list()[-1],
+                               reuse=True)
+            gate_conv1 = (first['gate_%d' % scale] -
+                          mean * gW_conv1_sum) / std + \
+                weights['Gate_conv1/biases']
+            gate = GatingNetwork('Gate_' + str(scale), None, reuse=True,
+                                 conv1=gate_conv1, num_output=1).output
+            msoes[scale] = gate * up_msoe + (1 - gate) * msoe_scale
+
+        output = conv3d('MSOEnet_conv3', msoes[0], 1, 1, 2, reuse=True)
+        self.output = reshape('reshape', output,
+                              [-1, tf.shape(output)[2],
+                               tf.shape(output)[3], 2])
+
+    def _empty_features(self, height, width):
+        """ Zero-frame stand-in for the cache before the first frame """
+        features = {'sum': np.zeros([0], np.float32),
+                    'sum_squares': np.zeros([0], np.float32)}
+        for scale in range(self.num_scales):
+            features['msoe_tap0_%d' % scale] = \
+                np.zeros([0, 1, height, width, 32], np.float32)
+            features['gate_%d' % scale] = \
+                np.zeros([0, 1, height, width, 4], np.float32)
+            # blur_downsample3d output size
+            height, width = (height + 1) / 2, (width + 1) / 2
+        return features
+
+    def _frame_batches(self, source):
+        """ Yields (index of the first frame, batch of frames) """
+        frames = []
+        start = 0
+        for t, frame in enumerate(read_frames(source)):
+            frames.append(preprocess_frame(frame))
+            if len(frames) == self.batch_size:
+                yield start, np.array(frames)
+                frames = []
+                start = t + 1
+
+        # evaluate the rest (if there are any)
+        if frames:
+            yield start, np.array(frames)
+
+    def flows(self, source):
+        """
+        Yields (t, flow) for every frame pair (t, t+1) of source. Flows are
+        h x w x 2 with fy pointing up, like the training targets.
+        """
+        self.cache.clear()
+        for start, frames in prefetch(self._frame_batches(source),
+                                      self.prefetch_batches):
+            previous = self.cache.get(start - 1)
+            if previous is None:
+                previous = self._empty_features(frames.shape[1],
+                                                frames.shape[2])
+                first_t = start
+            else:
+                first_t = start - 1
+
+            feed_dict = {self.frames: frames}
+            for key, placeholder in self.previous.items():
+                feed_dict[placeholder] = previous[key]
+            results, last = self.sess.run([self.output, self.last],
+                                          feed_dict=feed_dict)
+
+            # ring buffer of per-frame features keyed by frame index
+            self.cache[start + len(frames) - 1] = last
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+            for i, flow in enumerate(results):
+                yield first_t + i, flow
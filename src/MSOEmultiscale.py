@@ -1,12 +1,19 @@
 import tensorflow as tf
 from src.graph_components import *
 from src.utilities import *
-from src.MSOEnet import MSOEnet
+from src.MSOEnet import MSOEnet, MSOEnetPacked
 from src.GatingNetwork import GatingNetwork
+from src.CheckpointWriter import CheckpointWriter, load_training_state
+from src.evaluation import segment_epe
 import time
 import datetime
 import numpy as np
 
+# supported compute precisions (the variables are always float32). bfloat16
+# is left out: TF1 has no CPU Conv3D/AvgPool3D kernels for it
+PRECISIONS = {'float32': tf.float32,
+              'float16': tf.float16}
+
 
 class MSOEmultiscale(object):
 
@@ -15,48 +22,109 @@ class MSOEmultiscale(object):
         self.user_config = config['user']
         self.tf_config = config['tf']
 
+        # device the model is placed on ('/cpu:0' for CPU-only nodes)
+        self.device = self.user_config.get(
+            'device', '/gpu:' + str(self.user_config.get('gpu', 0)))
+
+        # CPU thread pools and core pinning. The session thread pools are
+        # created by this thread later on and inherit its affinity
+        self.compute_cores = make_session_config(self.tf_config,
+                                                 self.user_config)
+        set_affinity(self.compute_cores)
+
+        # inference-only graphs have no data layer, loss or summaries
+        self.train = self.user_config.get('train', True)
+
+        # compute precision of everything after contrast_norm
+        precision = self.user_config.get('precision', 'float32')
+        if precision not in PRECISIONS:
+            raise ValueError('MSOEmultiscale: unsupported precision %s '
+                             '(choose from %s)' %
+                             (precision, ', '.join(sorted(PRECISIONS))))
+        self.dtype = PRECISIONS[precision]
+
         self.graph = tf.Graph()
         with self.graph.as_default():
-            with tf.device('/gpu:' + str(self.user_config['gpu'])):
-                # retrieve training and validation data
-                self.data, input_shape, target_shape = \
-                    data_layer('data_layer',
-                               self.user_config['train_filename'],
-                               self.user_config['batch_size'],
-                               self.user_config['num_threads'])
-
-                # set queue runner
-                self.queue_runner = self.data['queue_runner']
-
-                # create input and target placeholders for feeding in training
-                # data, validation data, or test dat
-                self.input = tf.placeholder(dtype=tf.float32,
-                                            shape=[None] + input_shape,
-                                            name='input')
-                self.target = tf.placeholder(dtype=tf.float32,
-                                             shape=[None] + target_shape,
-                                             name='target')
+            with tf.device(self.device):
+                if self.train:
+                    # retrieve training and validation data
+                    self.data, input_shape, target_shape = \
+                        data_layer('data_layer',
+                                   self.user_config['train_filename'],
+                                   self.user_config['batch_size'],
+                                   self.user_config['num_threads'],
+                                   self.user_config.get('num_processes', 0),
+                                   self.user_config.get('loader_cores'),
+                                   self.user_config.get('augment', False),
+                                   self.user_config.get('augmentation'),
+                                   self.user_config.get('crop_size'),
+                                   self.user_config.get(
+                                       'patches_per_sample', 1))
+
+                    # set queue runner
+                    self.queue_runner = self.data['queue_runner']
+                else:
+                    # frame pairs and flows
+                    input_shape = [2, None, None, 1]
+                    target_shape = [None, None, 2]
+                    self.queue_runner = None
+
+                # create input and target placeholders for feeding in
+                # validation data or test data. Unless feed_train_data is set,
+                # they default to the dequeued training batch so that training
+                # steps consume the queue directly (no host round-trip).
+                # Spatial dimensions are left open since the pyramid is fully
+                # convolutional and may be fed frames of any size
+                input_shape = [None, input_shape[0], None, None,
+                               input_shape[3]]
+                target_shape = [None, None, None, target_shape[2]]
+                self.feed_train_data = \
+                    self.user_config.get('feed_train_data', False)
+                if self.feed_train_data or not self.train:
+                    self.input = tf.placeholder(dtype=tf.float32,
+                                                shape=input_shape,
+                                                name='input')
+                    self.target = tf.placeholder(dtype=tf.float32,
+                                                 shape=target_shape,
+                                                 name='target')
+                else:
+                    self.input = tf.placeholder_with_default(
+                        self.data['train']['input'],
+                        shape=input_shape,
+                        name='input')
+                    self.target = tf.placeholder_with_default(
+                        self.data['train']['target'],
+                        shape=target_shape,
+                        name='target')
 
                 # build multi-scale pyramid
                 self.output = self.build_pyramid('MSOEmultiscale', self.input)
 
-                # attach loss to be minimized
-                self.train_epe_squared = \
-                    squared_epe('train_epe_squared', self.output, self.target) + \
-                    tf.add_n(tf.get_collection('weight_regs'))
+                if self.train:
+                    # attach loss to be minimized
+                    self.tower_losses = [
+                        squared_epe('train_epe_squared', self.output,
+                                    self.target) +
+                        tf.add_n(tf.get_collection('weight_regs'))]
+
+                    # data-parallel replicas of the pyramid (sharing its
+                    # variables), each on its own dequeued batch
+                    self.build_towers()
 
-                # attach loss to be used for validation
-                self.val_epe = \
-                    epe('validation_epe', self.output, self.target)
+                    self.train_epe_squared = \
+                        tf.add_n(self.tower_losses) / len(self.tower_losses)
 
-                # attach loss segmented by speeds (for validation)
+                # attach losses to be used for validation: EPE sums and pixel
+                # counts per speed segment from a single pass over the flows
                 self.num_segments = 8
-                self.val_epes_segmented = \
-                    epe_speedsegmented('validation_epe_segmented',
-                                       self.output, self.target, self.num_segments)
+                self.val_epe_sums, self.val_epe_counts = \
+                    epe_segment_sums('validation_epe_segmented',
+                                     self.output, self.target,
+                                     self.num_segments)
 
-                # attach summaries
-                self.attach_summaries('summaries')
+                if self.train:
+                    # attach summaries
+                    self.attach_summaries('summaries')
 
     # TODO: clean this up and refactor
     def attach_summaries(self, name):
@@ -153,8 +221,22 @@ class MSOEmultiscale(object):
 
     def build_pyramid(self, name, input_layer, reuse=None):
         with tf.get_default_graph().name_scope(name):
-            # contrast normalize input
-            input_layer = contrast_norm('contrast_norm', input_layer)
+            # contrast normalize input. The moments can be fed instead of
+            # computed (e.g. full-frame moments when evaluating tiles)
+            mean, var = tf.nn.moments(input_layer, axes=[1, 2, 3, 4],
+                                      keep_dims=True)
+            self.input_mean = tf.placeholder_with_default(
+                mean, shape=[None, 1, 1, 1, 1], name='input_mean')
+            self.input_var = tf.placeholder_with_default(
+                var, shape=[None, 1, 1, 1, 1], name='input_var')
+            input_layer = contrast_norm('contrast_norm', input_layer,
+                                        moments=(self.input_mean,
+                                                 self.input_var))
+
+            # reduced precision: the rest of the pyramid runs in self.dtype
+            # (contrast_norm and the l1_normalize sums stay in float32)
+            if self.dtype != tf.float32:
+                input_layer = tf.cast(input_layer, self.dtype)
 
             # initialize input pyramid
             inputs = [input_layer]
@@ -169,9 +251,19 @@ class MSOEmultiscale(object):
                                                 sigma=2)
                 inputs.append(small_input)
 
+            # MSOEnets of all scales as single convolutions over an atlas of
+            # the input pyramid
+            packed_msoes = None
+            if self.user_config.get('pack_scales', False):
+                packed_msoes = MSOEnetPacked('MSOEnet_packed', inputs,
+                                             reuse).outputs
+
             # initial MSOEnet on smallest input (batchx1xhxwx64)
-            initial_msoe = MSOEnet('MSOEnet_'+str(num_scales-1),
-                                   inputs[num_scales-1], reuse).output
+            if packed_msoes:
+                initial_msoe = packed_msoes[num_scales-1]
+            else:
+                initial_msoe = MSOEnet('MSOEnet_'+str(num_scales-1),
+                                       inputs[num_scales-1], reuse).output
 
             # initialize MSOEnet pyramid
             msoes = [None]*num_scales
@@ -180,8 +272,11 @@ class MSOEmultiscale(object):
             # MSOEnet pyramid (small to big)
             for scale in range(num_scales-2, -1, -1):
                 # create a MSOEnet and insert data (batchx1xhxwx64)
-                msoe = MSOEnet('MSOEnet_' + str(scale), inputs[scale],
-                               reuse=True).output
+                if packed_msoes:
+                    msoe = packed_msoes[scale]
+                else:
+                    msoe = MSOEnet('MSOEnet_' + str(scale), inputs[scale],
+                                   reuse=True).output
 
                 # upsample previous MSOEnet output (batchx1xhxwx64)
                 can_reuse = reuse if scale == num_scales-2 else True
@@ -204,6 +299,8 @@ class MSOEmultiscale(object):
 
             # fourth convolution (flow out i.e. decode) (1x1x1x64x2)
             output = conv3d('MSOEnet_conv3', msoes[0], 1, 1, 2, reuse)
+            if self.dtype != tf.float32:
+                output = tf.to_float(output)
 
             # reshape (batch x H x W x 2)
             output = reshape('reshape', output,
@@ -212,6 +309,107 @@ class MSOEmultiscale(object):
 
             return output
 
+    def build_towers(self):
+        """
+        Build towers 1..num_towers-1 on tower_devices (tower 0 is the pyramid
+        on the input placeholders) and append their losses to tower_losses
+        """
+        num_towers = self.user_config.get('num_towers', 1)
+        self.tower_devices = self.user_config.get('tower_devices',
+                                                  [self.device] * num_towers)
+        if len(self.tower_devices) != num_towers:
+            raise ValueError('MSOEmultiscale: %d tower devices for %d towers'
+                             % (len(self.tower_devices), num_towers))
+
+        # keep the tensors tower 0 exposes for feeding and summaries
+        exposed = (self.input_mean, self.input_var, self.multiscale_inputs)
+        for tower in range(1, num_towers):
+            with tf.device(self.tower_devices[tower]):
+                with tf.device('/cpu:0'):
+                    input, target = self.queue_runner.get_inputs()
+                if self.data['augmentation'] is not None:
+                    input, target = augment_layer(
+                        'augmentation_tower_' + str(tower), input, target,
+                        self.data['augmentation'])
+                num_regs = len(tf.get_collection('weight_regs'))
+                output = self.build_pyramid('MSOEmultiscale_tower_' +
+                                            str(tower), input, reuse=True)
+                regs = tf.get_collection('weight_regs')[num_regs:]
+                self.tower_losses.append(
+                    squared_epe('train_epe_squared_tower_' + str(tower),
+                                output, target) + tf.add_n(regs))
+        self.input_mean, self.input_var, self.multiscale_inputs = exposed
+
+    def build_train_step(self):
+        """
+        Create the optimizer and training op (only once per graph). With
+        several towers, every tower computes its gradients on its own
+        device and their average is applied by a single Adam update.
+        """
+        if getattr(self, 'train_step', None) is None:
+            with self.graph.as_default():
+                optimizer = tf.train.AdamOptimizer(
+                    learning_rate=self.user_config['lr'])
+                if len(self.tower_losses) == 1:
+                    with tf.device(self.device):
+                        self.train_step = \
+                            optimizer.minimize(self.train_epe_squared)
+                else:
+                    tower_grads = []
+                    for device, loss in zip(self.tower_devices,
+                                            self.tower_losses):
+                        with tf.device(device):
+                            tower_grads.append(
+                                optimizer.compute_gradients(loss))
+                    with tf.device(self.device):
+                        grads = average_gradients('average_gradients',
+                                                  tower_grads)
+                        self.train_step = optimizer.apply_gradients(grads)
+        return self.train_step
+
+    def train_feed_dict(self, sess):
+        """
+        Returns the feed_dict for a training step. Empty when the pyramid
+        consumes the queue directly, otherwise the dequeued batch is pulled
+        to the host and fed back through the placeholders.
+        """
+        if not self.feed_train_data:
+            return {}
+        data = sess.run([self.data['train']['input'],
+                         self.data['train']['target']])
+        return {self.input: data[0], self.target: data[1]}
+
+    def run_benchmark(self, iterations, warmup=10):
+        """
+        Time bare training steps (no summaries, validation or snapshots) and
+        return the number of iterations per second
+        """
+        with self.graph.as_default():
+            train_step = self.build_train_step()
+
+            # fork the loader processes before the session's thread pools
+            self.queue_runner.start_loader()
+            with tf.Session(config=self.tf_config) as sess:
+                sess.run(tf.global_variables_initializer())
+
+                # start the tensorflow QueueRunners
+                tf.train.start_queue_runners(sess=sess)
+
+                # start the data queue runner's threads
+                threads = self.queue_runner.start_threads(sess)
+
+                for i in range(warmup):
+                    sess.run(train_step, feed_dict=self.train_feed_dict(sess))
+
+                start = time.time()
+                for i in range(iterations):
+                    sess.run(train_step, feed_dict=self.train_feed_dict(sess))
+                it_per_sec = iterations / (time.time() - start)
+
+                self.queue_runner.stop_threads(sess, threads)
+
+                return it_per_sec
+
     def run_train(self):
         # for cleanliness
         iterations = self.user_config['iterations']
@@ -222,48 +420,59 @@ class MSOEmultiscale(object):
         run_id = self.user_config['run_id']
 
         with self.graph.as_default():
-            with tf.device('/gpu:' + str(self.user_config['gpu'])):
-                optimizer = tf.train.AdamOptimizer(learning_rate=lr)
-                train_step = optimizer.minimize(self.train_epe_squared)
+            train_step = self.build_train_step()
 
             """
             Train over iterations, printing loss at each one
             """
             saver = tf.train.Saver(max_to_keep=0, pad_step_number=16)
-            with tf.Session(config=self.tf_config) as sess:
 
-                # check snapshots
-                resume, start_iteration = check_snapshots(run_id)
+            # check snapshots
+            resume, start_iteration = \
+                check_snapshots(run_id, self.user_config.get('resume', True))
+
+            # restore the data sampler before any loader draws from it (this
+            # resumes the RNG of the loader threads; ProcessLoader workers
+            # reseed themselves and queued batches are not replayed, so the
+            # sample stream is not reproduced exactly)
+            dataset = self.data['dataset']
+            if resume:
+                state = load_training_state(resume)
+                if state is not None:
+                    dataset.set_state(state['dataset'])
+
+            # fork the loader processes before the session's thread pools
+            self.queue_runner.start_loader()
+            with tf.Session(config=self.tf_config) as sess:
 
                 # start summary writers
                 summary_writer = tf.summary.FileWriter('logs/' + run_id, sess.graph)
 
+                # restore the model and optimizer variables
+                if resume:
+                    saver.restore(sess, resume)
+                else:
+                    sess.run(tf.global_variables_initializer())
+
                 # start the tensorflow QueueRunners
                 tf.train.start_queue_runners(sess=sess)
 
                 # start the data queue runner's threads
                 threads = self.queue_runner.start_threads(sess)
 
-                if resume:
-                    saver.restore(sess, resume)
-                else:
-                    sess.run(tf.global_variables_initializer())
+                # snapshots are serialized off the training thread
+                checkpoint_writer = CheckpointWriter(
+                    saver, tf.global_variables(), 'snapshots/' + run_id,
+                    keep_last=self.user_config.get('keep_last_snapshots', 5),
+                    keep_every=self.user_config.get('keep_snapshot_every'))
 
                 last_print = time.time()
                 for i in range(start_iteration, iterations):
-                    # retrieve training data
-                    data = sess.run([self.data['train']['input'],
-                                     self.data['train']['target']])
-                    input = data[0]
-                    target = data[1]
-
-                    # run a train step
+                    # run a train step (retrieves training data as well)
                     results = sess.run([train_step,
                                         self.train_epe_squared,
                                         self.summaries],
-                                       feed_dict={
-                                           self.input: input,
-                                           self.target: target})
+                                       feed_dict=self.train_feed_dict(sess))
 
                     # print training information
                     if (i + 1) % print_frequency == 0:
@@ -282,52 +491,17 @@ class MSOEmultiscale(object):
 
                     # print validation information
                     if (i + 1) % validation_frequency == 0:
-                        # retrieve validation data
-                        val_input = self.data['validation']['input']
-                        val_target = self.data['validation']['target']
-
-                        num_validation = val_target.shape[0]
+                        # stream validation data
+                        num_validation = dataset.num_validation
                         batch_size = self.user_config['batch_size']
 
                         print 'Validating ' + str(num_validation) + \
                             ' examples...'
 
-                        # breaking up large validation data into chunks
-                        # to evaluate separately
-                        assert batch_size < num_validation
-                        num_chunks = num_validation / batch_size
-                        val_epe = 0
-                        val_epes_segmented = np.zeros(self.num_segments)
-                        for j in range(num_chunks):
-                            start = j*batch_size
-                            end = (j+1)*batch_size
-                            results = sess.run([self.val_epe] +
-                                               self.val_epes_segmented,
-                                               feed_dict={
-                                                   self.input:
-                                                   val_input[start:end],
-                                                   self.target:
-                                                   val_target[start:end]})
-                            val_epe += results[0]
-                            val_epes_segmented += results[1:]
-
-                        # evaluate the rest (if there are any)
-                        if num_validation % batch_size != 0:
-                            start = num_chunks*batch_size
-                            results = sess.run([self.val_epe] +
-                                               val_epes_segmented,
-                                               feed_dict={
-                                                   self.input:
-                                                   val_input[start:],
-                                                   self.target:
-                                                   val_target[start:]})
-                            val_epe += results[0]
-                            val_epes_segmented += results[1:]
-                            val_epe /= num_chunks + 1
-                            val_epes_segmented /= num_chunks + 1
-                        else:
-                            val_epe /= num_chunks
-                            val_epes_segmented /= num_chunks
+                        val_epe, val_epes_segmented, _, _ = \
+                            self.evaluate(sess,
+                                          dataset.validation_batches(
+                                              batch_size))
 
                         print 'Validation epe: %f' % (val_epe)
 
@@ -352,34 +526,51 @@ class MSOEmultiscale(object):
                     # save snapshot
                     if (i + 1) % snapshot_frequency == 0:
                         print 'Saving snapshot...'
-                        try:
-                            os.makedirs('snapshots/' + run_id)
-                        except OSError:
-                            if not os.path.isdir('snapshots/' + run_id):
-                                raise
-                        saver.save(sess, 'snapshots/' + run_id + '/iter', global_step=i+1)
-
-    # TODO: revisit this code
-    def run_test(self):
+                        checkpoint_writer.save(
+                            sess, i + 1, {'dataset': dataset.get_state()})
+
+                # wait for the last snapshot to be written
+                checkpoint_writer.close()
+
+    def evaluate(self, sess, batches):
+        """
+        Streams (input, target) chunks through the fused evaluator (see
+        evaluation.segment_epe). Returns the overall EPE, the EPE of every
+        speed segment, the segment pixel counts and the seconds per batch.
+        """
+        return segment_epe(sess, self.val_epe_sums, self.val_epe_counts,
+                           self.input, self.target, batches)
+
+    def run_test(self, input):
+        """
+        Restores the latest checkpoint of the model_folder config (default
+        final_model) and returns the flows of input (batch x 2 x h x w x 1)
+        """
         with self.graph.as_default():
-            # TODO: switch to tf.train.import_meta_graph
             saver = tf.train.Saver(max_to_keep=0)
             with tf.Session(config=self.tf_config) as sess:
                 # load model
-                model = check_snapshots(folder='final_model', train=False)
+                folder = self.user_config.get('model_folder', 'final_model')
+                model = latest_checkpoint(folder)
+                if model is None:
+                    raise ValueError('run_test: no checkpoint in ' + folder)
                 saver.restore(sess, model)
 
-                result = sess.run([self.output])[0]
+                result = sess.run(self.output, feed_dict={self.input: input})
                 return result
 
-    # TODO: revisit this code
     def save_model(self):
+        """
+        Copies the latest snapshot of the run_id config to
+        final_model/MSOEnet.ckpt
+        """
         with self.graph.as_default():
             saver = tf.train.Saver(max_to_keep=0)
             with tf.Session(config=self.tf_config) as sess:
                 # load model
-                model = check_snapshots(train=False)
+                folder = 'snapshots/' + self.user_config['run_id']
+                model = latest_checkpoint(folder)
+                if model is None:
+                    raise ValueError('save_model: no checkpoint in ' + folder)
                 saver.restore(sess, model)
-                saver.save(sess, 'final_model/MSOEnet.ckpt')
-                for op in self.graph.get_operations():
-                    print op.name
+                return saver.save(sess, 'final_model/MSOEnet.ckpt')
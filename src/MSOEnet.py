@@ -4,19 +4,22 @@ from src.graph_components import *
 
 class MSOEnet(object):
 
-    def __init__(self, name, input, reuse=None):
+    def __init__(self, name, input, reuse=None, conv1=None):
         self.name = name
         self.temporal_extent = 2
         self.nbands = 2
-        self.input_shape = input.get_shape().as_list()
+        if input is not None:
+            self.input_shape = input.get_shape().as_list()
 
         with tf.get_default_graph().name_scope(self.name):
             """
-            Construct the MSOE network graph structure
+            Construct the MSOE network graph structure (conv1 can be passed in
+            precomputed, in which case input is not used)
             """
-            # first convolution (2x11x11x1x32)
-            conv1 = conv3d('MSOEnet_conv1', input, 11,
-                           self.temporal_extent, 32, reuse)
+            if conv1 is None:
+                # first convolution (2x11x11x1x32)
+                conv1 = conv3d('MSOEnet_conv1', input, 11,
+                               self.temporal_extent, 32, reuse)
             # activation
             h_conv1 = eltwise_square('square', conv1)
             # average pooling (1x5x5x1x1)
@@ -27,3 +30,48 @@ class MSOEnet(object):
             l1_norm = l1_normalize('l1_norm', conv2)
 
             self.output = l1_norm
+
+
+class MSOEnetPacked(object):
+
+    def __init__(self, name, inputs, reuse=None):
+        self.name = name
+        self.temporal_extent = 2
+        self.nbands = 2
+
+        with tf.get_default_graph().name_scope(self.name):
+            """
+            Construct the MSOE network of every pyramid level (inputs, big to
+            small) in one pass: the levels are packed into an atlas so the
+            shared conv1/conv2 weights run as single large convolutions,
+            and the per-level outputs are cropped back out of it
+            """
+            # SYMMETRIC padded levels (conv1 halo) side by side
+            atlas, origins = atlas_pack('atlas', inputs, 5)
+            # ones on the levels, zeros in the gaps between them
+            mask, _ = atlas_pack('mask', [tf.ones_like(input[:1, :1])
+                                          for input in inputs], 5, 'CONSTANT')
+            mask = mask[:, :, 5:-5, 5:-5]
+
+            # first convolution (2x11x11x1x32)
+            conv1 = conv3d('MSOEnet_conv1', atlas, 11,
+                           self.temporal_extent, 32, reuse, padding='VALID')
+            # activation (the gaps hold responses across level borders)
+            h_conv1 = eltwise_square('square', conv1) * mask
+            # average pooling (1x5x5x1x1) within every level: the levels are
+            # at least 10 pixels apart, so normalizing by the pooled mask
+            # averages over the taps inside the level only
+            pool1 = avg_pool3d('avg_pool', h_conv1, 5, 1) / \
+                tf.maximum(avg_pool3d('mask_pool', mask, 5, 1), 1e-2)
+            # second convolution (1x1x1x32x64)
+            conv2 = conv3d('MSOEnet_conv2', pool1, 1, 1, 64, reuse)
+            # channel-wise l1 normalization (batchx1xHxWx64)
+            l1_norm = l1_normalize('l1_norm', conv2)
+
+        # unpack the levels
+        self.outputs = []
+        for scale, (y, x) in enumerate(origins):
+            with tf.get_default_graph().name_scope('MSOEnet_' + str(scale)):
+                size = tf.shape(inputs[scale])[2:4]
+                self.outputs.append(l1_norm[:, :, y:y + size[0],
+                                            x:x + size[1]])
@@ -0,0 +1,124 @@
+import multiprocessing
+import traceback
+import numpy as np
+from src.utilities import set_affinity
+
+
+class LoaderError(Exception):
+    """ Raised by ProcessLoader.get when a worker process failed """
+    pass
+
+
+class ProcessLoader(object):
+    """
+    This class manages a pool of worker processes that decode batches with
+        DataSet.next_batch into shared-memory batch slots. Decoding is then
+        not serialized by the GIL; the parent only hands the filled slots
+        over to whoever enqueues them.
+    """
+    def __init__(self, dataset, input_shape, target_shape, batch_size,
+                 n_processes=1, n_slots=None, augment_data=False, seed=None,
+                 cores=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.n_processes = n_processes
+        self.n_slots = n_slots or 2 * n_processes
+        self.augment_data = augment_data
+        self.cores = cores
+        self.input_shape = [batch_size] + list(input_shape)
+        self.target_shape = [batch_size] + list(target_shape)
+        if seed is None:
+            seed = np.random.randint(0, 2**31 - 1 - n_processes)
+        self.seed = seed
+
+        # shared-memory batch slots (allocated before forking so that every
+        # worker maps the same buffers)
+        self._inputs = [multiprocessing.RawArray(
+                            'f', int(np.prod(self.input_shape)))
+                        for _ in range(self.n_slots)]
+        self._targets = [multiprocessing.RawArray(
+                             'f', int(np.prod(self.target_shape)))
+                         for _ in range(self.n_slots)]
+
+        # slot indices cycle from free (parent -> workers) to ready
+        # (workers -> parent) and back again
+        self._free = multiprocessing.Queue()
+        self._ready = multiprocessing.Queue()
+        for slot in range(self.n_slots):
+            self._free.put(slot)
+
+        self._workers = []
+
+    def _slot_arrays(self, slot):
+        dataX = np.frombuffer(self._inputs[slot], dtype=np.float32)
+        dataY = np.frombuffer(self._targets[slot], dtype=np.float32)
+        return dataX.reshape(self.input_shape), \
+            dataY.reshape(self.target_shape)
+
+    def _worker_main(self, worker_id):
+        """
+        Function run in the worker processes. Keep filling free slots with
+        freshly decoded batches.
+        """
+        set_affinity(self.cores)
+
+        # independent sampling stream per worker
+        np.random.seed(self.seed + worker_id)
+        while True:
+            slot = self._free.get()
+            if slot is None:
+                return
+            try:
+                x_batch, y_batch = self.dataset.next_batch(
+                    self.batch_size, self.augment_data)
+                dataX, dataY = self._slot_arrays(slot)
+                dataX[...] = x_batch
+                dataY[...] = y_batch
+            except Exception:
+                # hand the failure to the parent rather than dying silently
+                # (which would leave it waiting for a batch forever)
+                self._ready.put(('error', worker_id, traceback.format_exc()))
+                return
+            self._ready.put(slot)
+
+    def start(self):
+        """ Start the worker processes """
+        for n in range(self.n_processes):
+            p = multiprocessing.Process(target=self._worker_main, args=(n,))
+            p.daemon = True  # process will close when parent quits
+            p.start()
+            self._workers.append(p)
+        return self._workers
+
+    def get(self):
+        """
+        Returns the slot index and the (input, target) views of a filled
+        batch, or None once the loader is stopped. The views are only valid
+        until the slot is released. Raises LoaderError if a worker failed.
+        """
+        slot = self._ready.get()
+        if slot is None:
+            # pass the stop signal on to the next waiting consumer
+            self._ready.put(None)
+            return None
+        if isinstance(slot, tuple):
+            # pass the failure on to the next waiting consumer as well
+            self._ready.put(slot)
+            _, worker_id, error = slot
+            raise LoaderError('ProcessLoader: worker %d failed:\n%s' %
+                              (worker_id, error))
+        dataX, dataY = self._slot_arrays(slot)
+        return slot, dataX, dataY
+
+    def release(self, slot):
+        """ Hand a consumed slot back to the workers """
+        self._free.put(slot)
+
+    def stop(self):
+        """ Terminate the worker processes and wake up waiting consumers """
+        for p in self._workers:
+            p.terminate()
+        for p in self._workers:
+            p.join()
+        self._workers = []
+        self._ready.put(None)
@@ -1,5 +1,7 @@
 import tensorflow as tf
 import threading
+from src.ProcessLoader import ProcessLoader, LoaderError
+from src.utilities import set_affinity
 
 
 class QueueRunner(object):
@@ -8,11 +10,17 @@ class QueueRunner(object):
         a queue full of data.
     """
     def __init__(self, dataset, input_shape, target_shape, batch_size,
-                 n_threads=1):
+                 n_threads=1, n_processes=0, loader_cores=None,
+                 augment_data=False):
         self.dataset = dataset
         self.batch_size = batch_size
         self.n_threads = n_threads
-        self.augment_data = False
+        self.n_processes = n_processes
+        self.loader_cores = loader_cores  # keep decoding off compute cores
+        self.augment_data = augment_data
+        self.input_shape = input_shape
+        self.target_shape = target_shape
+        self.loader = None
 
         input_shape = [None] + input_shape
         target_shape = [None] + target_shape
@@ -29,6 +37,9 @@ class QueueRunner(object):
         # The symbolic operation to add data to the queue
         self.enqueue_op = self.queue.enqueue_many([self.dataX, self.dataY])
 
+        # The symbolic operation to unblock and stop the feeding threads
+        self.close_op = self.queue.close(cancel_pending_enqueues=True)
+
     def get_inputs(self):
         """
         Returns tensors containing a batch of images and labels
@@ -41,12 +52,49 @@ class QueueRunner(object):
         Function run on alternate thread. Basically, keep adding data to the
         queue.
         """
-        for dataX, dataY in self._data_iterator():
-            sess.run(self.enqueue_op, feed_dict={self.dataX: dataX,
-                                                 self.dataY: dataY})
+        set_affinity(self.loader_cores)
+
+        if self.loader is not None:
+            # batches are decoded by the worker processes, only enqueue
+            data_iterator = self._loader_iterator()
+        else:
+            data_iterator = self._data_iterator()
+
+        try:
+            for dataX, dataY in data_iterator:
+                sess.run(self.enqueue_op, feed_dict={self.dataX: dataX,
+                                                     self.dataY: dataY})
+        except (tf.errors.CancelledError, tf.errors.AbortedError,
+                RuntimeError):
+            # queue was closed or session ended, stop feeding
+            return
+        except LoaderError:
+            # a loader worker died: close the queue so that training stops
+            # (OutOfRangeError) instead of waiting for batches forever
+            sess.run(self.close_op)
+            raise
+
+    def start_loader(self):
+        """
+        Start the worker processes decoding the batches (if n_processes > 0).
+        Call this before creating the session: forking once TensorFlow's
+        thread pools are running risks inheriting locks held by them (e.g.
+        OpenMP/MKL) and deadlocking the workers.
+        """
+        if self.n_processes > 0 and self.loader is None:
+            # decode in worker processes instead of the feeding threads
+            self.loader = ProcessLoader(self.dataset, self.input_shape,
+                                        self.target_shape, self.batch_size,
+                                        self.n_processes,
+                                        augment_data=self.augment_data,
+                                        cores=self.loader_cores)
+            self.loader.start()
 
     def start_threads(self, sess):
         """ Start background threads to feed queue """
+        # no-op if the loader was started before the session
+        self.start_loader()
+
         threads = []
         for n in range(self.n_threads):
             t = threading.Thread(target=self.thread_main, args=(sess,))
@@ -55,8 +103,32 @@ class QueueRunner(object):
             threads.append(t)
         return threads
 
+    def stop_threads(self, sess, threads):
+        """ Close the queue and wait for the background threads to exit """
+        # unblock the threads waiting to enqueue, and (by stopping the
+        # loader) those waiting for a decoded batch
+        sess.run(self.close_op)
+        if self.loader is not None:
+            self.loader.stop()
+        for t in threads:
+            t.join(timeout=10)
+        self.loader = None
+
     def _data_iterator(self):
         while True:
             x_batch, y_batch = self.dataset.next_batch(self.batch_size,
                                                        self.augment_data)
             yield x_batch, y_batch
+
+    def _loader_iterator(self):
+        loader = self.loader  # stop_threads drops self.loader
+        while True:
+            batch = loader.get()
+            if batch is None:
+                return  # loader stopped
+            slot, x_batch, y_batch = batch
+            try:
+                yield x_batch, y_batch
+            finally:
+                # slot is free again once the batch has been enqueued
+                loader.release(slot)
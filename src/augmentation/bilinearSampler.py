@@ -1,82 +1,78 @@
 import tensorflow as tf
 
 def bilinearSampler(im, grid, out_size):
-	def _repeat(x, n_repeats):
-		with tf.get_default_graph().name_scope('_repeat'):
-		    rep = tf.transpose(
-		        tf.expand_dims(tf.ones(shape=tf.stack([n_repeats, ])), 1), [1, 0])
-		    #modifications to the casting to force computations on the gpu
-		    #rep = tf.cast(rep, 'int32') #removed
-		    x = tf.cast(x,tf.float32) #new
-		    x = tf.matmul(tf.reshape(x, (-1, 1)), rep)
-		    x = tf.cast(x,tf.int32) #new
-		    return tf.reshape(x, [-1])
+	'''
+	Samples im (batch x height x width x channels, or batch x frames x
+	height x width x channels, with every frame sampled alike) bilinearly at
+	the normalized [-1, 1] coordinates of the x and y rows of grid (batch x
+	2+ x out_height*out_width)
+	'''
+	with tf.get_default_graph().name_scope('bilinearSampler'):
+		if im.get_shape().ndims == 5:
+			# frames as channels, so all of them take one gather
+			shape = tf.shape(im)
+			frames = tf.reshape(tf.transpose(im, [0, 2, 3, 1, 4]),
+					    tf.stack([shape[0], shape[2], shape[3],
+						      shape[1]*shape[4]]))
+			output = _sample(frames, grid, out_size)
+			output = tf.reshape(output, tf.stack([shape[0], out_size[0],
+							      out_size[1], shape[1],
+							      shape[4]]))
+			return tf.transpose(output, [0, 3, 1, 2, 4])
+		return _sample(im, grid, out_size)
 
-        with tf.get_default_graph().name_scope('bilinearSampler'):
-    		#split grid
-    		x = tf.reshape(tf.slice(grid,[0,0,0],[-1,1,-1]), [-1])
-    		y = tf.reshape(tf.slice(grid,[0,1,0],[-1,1,-1]), [-1])
+def _sample(im, grid, out_size):
+	# coordinates (batch x out_height*out_width)
+	x = tf.cast(grid[:, 0], 'float32')
+	y = tf.cast(grid[:, 1], 'float32')
 
-    		# constants
-    		num_batch = tf.shape(im)[0]
-    		height = tf.shape(im)[1]
-    		width = tf.shape(im)[2]
-    		channels = tf.shape(im)[3]
+	# constants
+	num_batch = tf.shape(im)[0]
+	height = tf.shape(im)[1]
+	width = tf.shape(im)[2]
+	channels = tf.shape(im)[3]
+	height_f = tf.cast(height, 'float32')
+	width_f = tf.cast(width, 'float32')
+	zero = tf.zeros([], dtype='int32')
+	max_y = height - 1
+	max_x = width - 1
 
-    		x = tf.cast(x, 'float32')
-    		y = tf.cast(y, 'float32')
-    		height_f = tf.cast(height, 'float32')
-    		width_f = tf.cast(width, 'float32')
-    		out_height = out_size[0]
-    		out_width = out_size[1]
-    		zero = tf.zeros([], dtype='int32')
-    		max_y = tf.cast(tf.shape(im)[1] - 1, 'int32')
-    		max_x = tf.cast(tf.shape(im)[2] - 1, 'int32')
+	# scale indices from [-1, 1] to [0, width/height]
+	# actually wrong in original code, need to scale by width-1
+	# warning! hack: subtract 1.00001 to get the floor to work
+	# correctly for badly rounded floats
+	x = (x + 1.0)*(width_f-1.00001) / 2.0
+	y = (y + 1.0)*(height_f-1.00001) / 2.0
 
-    		# scale indices from [-1, 1] to [0, width/height]
-    		# actually wrong in original code, need to scale by width-1
-    		# warning! hack: subtract 1.00001 to get the floor to work
-    		# correctly for badly rounded floats
-    		x = (x + 1.0)*(width_f-1.00001) / 2.0
-    		y = (y + 1.0)*(height_f-1.00001) / 2.0
+	# do sampling
+	x0 = tf.cast(tf.floor(x), 'int32')
+	x1 = x0 + 1
+	y0 = tf.cast(tf.floor(y), 'int32')
+	y1 = y0 + 1
 
-    		# do sampling
-    		x0 = tf.cast(tf.floor(x), 'int32')
-    		x1 = x0 + 1
-    		y0 = tf.cast(tf.floor(y), 'int32')
-    		y1 = y0 + 1
+	x0 = tf.clip_by_value(x0, zero, max_x)
+	x1 = tf.clip_by_value(x1, zero, max_x)
+	y0 = tf.clip_by_value(y0, zero, max_y)
+	y1 = tf.clip_by_value(y1, zero, max_y)
 
-    		x0 = tf.clip_by_value(x0, zero, max_x)
-    		x1 = tf.clip_by_value(x1, zero, max_x)
-    		y0 = tf.clip_by_value(y0, zero, max_y)
-    		y1 = tf.clip_by_value(y1, zero, max_y)
-    		dim2 = width
-    		dim1 = width*height
-    		base = _repeat(tf.range(num_batch)*dim1, out_height*out_width)
-    		base_y0 = base + y0*dim2
-    		base_y1 = base + y1*dim2
-    		idx_a = base_y0 + x0
-    		idx_b = base_y1 + x0
-    		idx_c = base_y0 + x1
-    		idx_d = base_y1 + x1
+	# offset of every sample's image in the flat image (batch x 1)
+	base = tf.expand_dims(tf.range(num_batch)*(width*height), 1)
+	base_y0 = base + y0*width
+	base_y1 = base + y1*width
 
-    		# use indices to lookup pixels in the flat image and restore
-    		# channels dim
-    		im_flat = tf.reshape(im, tf.stack([-1, channels]))
-    		im_flat = tf.cast(im_flat, 'float32')
-    		Ia = tf.gather(im_flat, idx_a)
-    		Ib = tf.gather(im_flat, idx_b)
-    		Ic = tf.gather(im_flat, idx_c)
-    		Id = tf.gather(im_flat, idx_d)
+	# the four neighbours in one lookup in the flat image
+	# (4 x batch x out_height*out_width x channels)
+	im_flat = tf.reshape(tf.cast(im, 'float32'), tf.stack([-1, channels]))
+	pixels = tf.gather(im_flat, tf.stack([base_y0 + x0, base_y1 + x0,
+					      base_y0 + x1, base_y1 + x1]))
 
-    		# and finally calculate interpolated values
-    		x0_f = tf.cast(x0, 'float32')
-    		x1_f = tf.cast(x1, 'float32')
-    		y0_f = tf.cast(y0, 'float32')
-    		y1_f = tf.cast(y1, 'float32')
-    		wa = tf.expand_dims(((x1_f-x) * (y1_f-y)), 1)
-    		wb = tf.expand_dims(((x1_f-x) * (y-y0_f)), 1)
-    		wc = tf.expand_dims(((x-x0_f) * (y1_f-y)), 1)
-    		wd = tf.expand_dims(((x-x0_f) * (y-y0_f)), 1)
-    		output = tf.add_n([wa*Ia, wb*Ib, wc*Ic, wd*Id])
-    		return tf.reshape(output, tf.stack([num_batch, out_height, out_width, channels]))
+	# and finally calculate interpolated values
+	x0_f = tf.cast(x0, 'float32')
+	x1_f = tf.cast(x1, 'float32')
+	y0_f = tf.cast(y0, 'float32')
+	y1_f = tf.cast(y1, 'float32')
+	weights = tf.stack([(x1_f-x) * (y1_f-y), (x1_f-x) * (y-y0_f),
+			    (x-x0_f) * (y1_f-y), (x-x0_f) * (y-y0_f)])
+	output = tf.reduce_sum(tf.expand_dims(weights, 3)*pixels, 0)
+	return tf.reshape(output, tf.stack([num_batch, out_size[0], out_size[1],
+					    channels]))
@@ -8,7 +8,8 @@ def flowTransformGrid(flow):
 		height = flowShape[1]
 		width = flowShape[2]
 
-		identityGrid = meshGridFlat(batchSize,height,width)
+		# broadcast over the batch in the sum below
+		identityGrid = identityGridFlat(height,width)
 
 		flowU = tf.slice(flow,[0,0,0,0],[-1,-1,-1,1])
 		flowV = tf.slice(flow,[0,0,0,1],[-1,-1,-1,1])
@@ -1,27 +1,34 @@
+import weakref
+import numpy as np
 import tensorflow as tf
 
-def meshGridFlat(batchSize, height, width):
-    with tf.get_default_graph().name_scope('meshGridFlat'):
-		# This should be equivalent to:
-		#  x_t, y_t = np.meshgrid(np.linspace(-1, 1, width),
-		#				 np.linspace(-1, 1, height))
-		#  ones = np.ones(np.prod(x_t.shape))
-		#  grid = np.vstack([x_t.flatten(), y_t.flatten(), ones])
-		x_t = tf.matmul(tf.ones(shape=tf.stack([height, 1])),
-				tf.transpose(tf.expand_dims(tf.linspace(-1.0, 1.0, width), 1), [1, 0]))
-		y_t = tf.matmul(tf.expand_dims(tf.linspace(-1.0, 1.0, height), 1),
-				tf.ones(shape=tf.stack([1, width])))
-
-		x_t_flat = tf.reshape(x_t, (1, -1))
-		y_t_flat = tf.reshape(y_t, (1, -1))
+# identity grids already in a graph, per graph and (height, width)
+_identityGrids = weakref.WeakKeyDictionary()
 
-		ones = tf.ones_like(x_t_flat)
-		grid = tf.concat(axis=0, values=[x_t_flat, y_t_flat, ones])
+def identityGridFlat(height, width):
+	'''
+	3 x (height*width) normalized identity grid (x, y, 1 rows) as a 1x3xN
+	constant, built once per graph and size
+	'''
+	height, width = int(height), int(width)
+	graph = tf.get_default_graph()
+	grids = _identityGrids.setdefault(graph, {})
+	if (height, width) not in grids:
+		x_t, y_t = np.meshgrid(np.linspace(-1, 1, width),
+				       np.linspace(-1, 1, height))
+		ones = np.ones(np.prod(x_t.shape))
+		grid = np.vstack([x_t.flatten(), y_t.flatten(), ones])
+		# outside of the caller's name scope, device, control dependencies
+		# and control flow context, since it is shared between callers
+		with graph.name_scope(None), graph.device(None), \
+				graph.control_dependencies(None):
+			grids[(height, width)] = tf.constant(
+				grid[np.newaxis].astype('float32'),
+				name='identityGrid_%dx%d' % (height, width))
+	return grids[(height, width)]
 
-		baseGrid = tf.expand_dims(grid,0)
-		grids = []
-		for i in range(batchSize):
-			grids.append(baseGrid)
-		identityGrid = tf.concat(axis=0,values=grids)
-
-		return identityGrid
+def meshGridFlat(batchSize, height, width):
+	with tf.get_default_graph().name_scope('meshGridFlat'):
+		# one copy of the cached identity grid per sample
+		return tf.tile(identityGridFlat(height, width),
+			       [int(batchSize), 1, 1])
@@ -0,0 +1,50 @@
+import time
+import numpy as np
+
+
+def segment_epe(sess, epe_sums, epe_counts, input, target, batches):
+    """
+    Streams (input, target) chunks through the fused EPE evaluator (see
+    graph_components.epe_segment_sums) and accumulates exact EPE sums and
+    pixel counts. Returns the overall EPE, the EPE of every speed segment,
+    the segment pixel counts and the seconds per batch (the first batch,
+    which builds the kernels, is not timed).
+    """
+    sums = 0.0
+    counts = 0.0
+    elapsed = 0.0
+    num_timed = 0
+    for i, (input_batch, target_batch) in enumerate(batches):
+        start = time.time()
+        results = sess.run([epe_sums, epe_counts],
+                           feed_dict={input: input_batch,
+                                      target: target_batch})
+        if i > 0:
+            elapsed += time.time() - start
+            num_timed += 1
+        sums += results[0]
+        counts += results[1]
+
+    mean_epe = np.sum(sums) / max(np.sum(counts), 1)
+    epes_segmented = sums / np.maximum(counts, 1)  # empty segments are 0
+    return mean_epe, epes_segmented, counts, elapsed / max(num_timed, 1)
+
+
+def print_epe_comparison(reference, other, reference_name, other_name):
+    """
+    Prints the per segment and overall EPE of two segment_epe results, the
+    change between them and their seconds per batch
+    """
+    print '%-10s %-12s %-12s %-12s %s' % ('segment', reference_name,
+                                          other_name, 'delta', 'pixels')
+    for i in range(len(reference[1])):
+        print '%-10d %-12f %-12f %-+12f %d' % (i, reference[1][i],
+                                               other[1][i],
+                                               other[1][i] - reference[1][i],
+                                               reference[2][i])
+    print '%-10s %-12f %-12f %-+12f %d' % ('all', reference[0], other[0],
+                                           other[0] - reference[0],
+                                           np.sum(reference[2]))
+    print 'sec/batch: %s %f, %s %f (%.2fx)' % \
+        (reference_name, reference[3], other_name, other[3],
+         reference[3] / other[3])
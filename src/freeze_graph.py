@@ -1,13 +1,57 @@
 import os
+import time
 import argparse
 
 import tensorflow as tf
 from tensorflow.python.framework import graph_util
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from src.MSOEmultiscale import MSOEmultiscale
 
 dir = os.path.dirname(os.path.realpath(__file__))
 
+# serving graph cleanup, run after the variables are frozen:
+# - strip_unused_nodes turns the input into a plain Placeholder, dropping
+#   the queue/data layer feeding its default
+# - remove_nodes drops the Identity reads left by the variables
+# - fold_constants precomputes everything that doesn't depend on the input
+#   (blur kernels, pad sizes, weight casts of reduced precision graphs)
+# - strip_unused_nodes and sort_by_execution_order tidy up what is left
+TRANSFORMS = ['strip_unused_nodes(type=float)',
+              'remove_nodes(op=Identity, op=CheckNumerics)',
+              'fold_constants(ignore_errors=true)',
+              'strip_unused_nodes(type=float)',
+              'sort_by_execution_order']
+
+
+def optimize_graph(input_graph_def, input_names=['input'],
+                   output_names=['MSOEmultiscale/reshape/Reshape']):
+    """
+    Runs the TRANSFORMS over a frozen graph and reports the op count and
+    load time before and after
+    """
+    output_graph_def = TransformGraph(input_graph_def, input_names,
+                                      output_names, TRANSFORMS)
+    for label, graph_def in [('before', input_graph_def),
+                             ('after', output_graph_def)]:
+        print("%-6s optimization: %d ops, %.3fs to load" %
+              (label, len(graph_def.node), load_time(graph_def)))
+    return output_graph_def
+
+
+def load_time(graph_def):
+    """ Seconds to parse and import a serialized graph into a session """
+    serialized = graph_def.SerializeToString()
+    start = time.time()
+    parsed = tf.GraphDef()
+    parsed.ParseFromString(serialized)
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(parsed, name='')
+        tf.Session(graph=graph).close()
+    return time.time() - start
+
 
-def freeze_graph(model_folder):
+def freeze_graph(model_folder, optimize=True):
     # We retrieve our checkpoint fullpath
     checkpoint = tf.train.get_checkpoint_state(model_folder)
     input_checkpoint = checkpoint.model_checkpoint_path
@@ -46,16 +90,79 @@ def freeze_graph(model_folder):
                                           # select the useful nodes
         )
 
+        # strip the training-only nodes and fold the constants
+        if optimize:
+            output_graph_def = optimize_graph(
+                output_graph_def, ['input'], output_node_names.split(","))
+
         # Finally we serialize and dump the output graph to the filesystem
         with tf.gfile.GFile(output_graph, "wb") as f:
             f.write(output_graph_def.SerializeToString())
         print("%d ops in the final graph." % len(output_graph_def.node))
 
 
+def freeze_inference_graph(model_folder, num_scales, precision,
+                           optimize=True):
+    """
+    Rebuilds an inference-only MSOEmultiscale (no data layer or loss) in the
+    given compute precision, restores the checkpoint weights into it and
+    exports it next to the checkpoint as MSOEmultiscale_<precision>.tfmodel
+    """
+    checkpoint = tf.train.get_checkpoint_state(model_folder)
+    input_checkpoint = checkpoint.model_checkpoint_path
+
+    absolute_model_folder = "/".join(input_checkpoint.split('/')[:-1])
+    output_graph = absolute_model_folder + \
+        "/MSOEmultiscale_%s.tfmodel" % precision
+
+    output_node_names = "MSOEmultiscale/reshape/Reshape"
+
+    net = MSOEmultiscale(config={'tf': tf.ConfigProto(),
+                                 'user': {'train': False,
+                                          'num_scales': num_scales,
+                                          'precision': precision}})
+    with net.graph.as_default():
+        # only the model variables are restored (no optimizer slots)
+        saver = tf.train.Saver()
+
+        # We clear devices to allow TensorFlow to control on which device it
+        # will load operations
+        input_graph_def = net.graph.as_graph_def()
+        for node in input_graph_def.node:
+            node.device = ""
+
+        with tf.Session() as sess:
+            saver.restore(sess, input_checkpoint)
+
+            output_graph_def = graph_util.convert_variables_to_constants(
+                sess, input_graph_def, output_node_names.split(","))
+            if optimize:
+                output_graph_def = optimize_graph(
+                    output_graph_def, ['input'], output_node_names.split(","))
+
+            with tf.gfile.GFile(output_graph, "wb") as f:
+                f.write(output_graph_def.SerializeToString())
+            print("%d ops in the final graph." % len(output_graph_def.node))
+
+    return output_graph
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_folder", type=str,
                         help="Model folder to export")
+    parser.add_argument("--precision", type=str, default=None,
+                        choices=['float32', 'float16'],
+                        help="Export an inference-only graph computing in "
+                             "this precision instead of the training graph")
+    parser.add_argument("--num_scales", type=int, default=5,
+                        help="Pyramid depth of the model (with --precision)")
+    parser.add_argument("--no_optimize", action="store_true",
+                        help="Only convert the variables to constants")
     args = parser.parse_args()
 
-    freeze_graph(args.model_folder)
+    if args.precision is None:
+        freeze_graph(args.model_folder, not args.no_optimize)
+    else:
+        freeze_inference_graph(args.model_folder, args.num_scales,
+                               args.precision, not args.no_optimize)
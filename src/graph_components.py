@@ -1,77 +1,164 @@
 import tensorflow as tf
-from src.Dataset import load_FlyingChairs, load_UCF101
+from src.Dataset import load_dataset
 from src.QueueRunner import QueueRunner
-from src.utilities import draw_hsv_ocv, gauss2d_kernel
+from src.utilities import draw_hsv_ocv, gauss2d_kernel, gauss1d_kernel
+from src.augmentation import geoAugTransform, geoAug, geoAugFlow, \
+    photoAugParam, photoAug
 from math import ceil
 import numpy as np
 
 
-def data_layer(name, train_filename, batch_size, num_threads):
+def data_layer(name, train_filename, batch_size, num_threads,
+               num_processes=0, loader_cores=None, augment=False,
+               augmentation=None, crop_size=None, patches_per_sample=1):
     with tf.get_default_graph().name_scope(name):
         # load dataset
-        if 'UCF' in train_filename:
-            d = load_UCF101(train_filename)
-        elif 'Chairs' in train_filename:
-            d = load_FlyingChairs(train_filename)
+        d = load_dataset(train_filename)
+        d.set_crop(crop_size, patches_per_sample)
 
-        # read validation data
-        X_val, y_val = d.validation_data()
+        # probe sample shapes (validation data is streamed when needed)
+        input_shape, target_shape = d.sample_shapes()
 
-        # get training and validation data
+        # get training data
         with tf.device("/cpu:0"):
-            input_shape = list(X_val.shape[1:])
-            target_shape = list(y_val.shape[1:])
             queue_runner = QueueRunner(d, input_shape, target_shape,
-                                       batch_size, num_threads)
+                                       batch_size, num_threads,
+                                       num_processes, loader_cores,
+                                       augment)
             X, y = queue_runner.get_inputs()
 
+        # in-graph augmentation of the dequeued batch (on the model device)
+        if augmentation is not None:
+            X, y = augment_layer('augmentation', X, y, augmentation)
+
         data = {'train': {'input': X, 'target': y},
-                'validation': {'input': X_val, 'target': y_val},
-                'queue_runner': queue_runner}
+                'dataset': d,
+                'queue_runner': queue_runner,
+                'augmentation': augmentation}
 
         return data, input_shape, target_shape
 
 
+# parameters of augment_layer (translations are in normalized coordinates,
+# i.e. 1.0 is half the frame, and rotations in radians)
+AUGMENTATION_DEFAULTS = {'translate': 0.1,
+                         'rotate': 0.17,
+                         'scale_min': 0.9,
+                         'scale_max': 1.1,
+                         'flip': True,
+                         'contrast_min': 0.8,
+                         'contrast_max': 1.2,
+                         'brightness_std': 0.05,
+                         'gamma_min': 0.8,
+                         'gamma_max': 1.2,
+                         'noise_std': 0.01}
+
+
+def augment_layer(name, input_layer, target, params):
+    """
+    Warps the frames and flow of every sample with one random affine
+    transform (the flow vectors are transformed as well) and applies
+    photometric jitter to the frames. params override AUGMENTATION_DEFAULTS;
+    the batch must have a static shape (e.g. a dequeued batch).
+    """
+    with tf.get_default_graph().name_scope(name):
+        params = dict(AUGMENTATION_DEFAULTS, **params)
+        batch_size, num_frames, height, width, channels = \
+            input_layer.get_shape().as_list()
+
+        transform = geoAugTransform(batch_size, params['translate'],
+                                    params['translate'], params['rotate'],
+                                    params['scale_min'], params['scale_max'],
+                                    params['flip'])
+
+        # frames as channels, so that all of them are warped (and jittered)
+        # alike
+        frames = tf.reshape(tf.transpose(input_layer, [0, 2, 3, 1, 4]),
+                            [batch_size, height, width,
+                             num_frames * channels])
+        frames = geoAug(frames, transform)
+        frames = photoAug(frames, photoAugParam(batch_size,
+                                                params['contrast_min'],
+                                                params['contrast_max'],
+                                                params['brightness_std'],
+                                                params['gamma_min'],
+                                                params['gamma_max'],
+                                                params['noise_std']))
+        input_layer = tf.transpose(tf.reshape(frames,
+                                              [batch_size, height, width,
+                                               num_frames, channels]),
+                                   [0, 3, 1, 2, 4])
+
+        # the augmentation module expects fy pointing down (image rows)
+        unflip = tf.constant([1.0, -1.0])
+        flow = geoAug(target * unflip, transform)
+        flow = geoAugFlow(flow, transform, transform) * unflip
+
+        return input_layer, flow
+
+
+def conv3d_variables(name, input_layer, kernel_spatial_size,
+                     kernel_temporal_size, out_channels):
+    """
+    Creates (or reuses) the weights and biases of a conv3d named name in the
+    current variable scope, cast to the dtype of input_layer
+    """
+    in_channels = input_layer.get_shape().as_list()[-1]
+
+    if name == 'Gate_conv1':
+        # MSRA initialization (avg variance norm)
+        initializer = tf.contrib.layers \
+                        .variance_scaling_initializer(factor=2.0,
+                                                      mode='FAN_AVG',
+                                                      uniform=False)
+    else:
+        initializer = tf.truncated_normal_initializer(stddev=0.4)
+
+    # going to be sharing variables
+    weights = tf.get_variable('weights',
+                              [kernel_temporal_size,
+                               kernel_spatial_size,
+                               kernel_spatial_size,
+                               in_channels,
+                               out_channels],
+                              initializer=initializer)
+    biases = tf.get_variable('biases',
+                             [out_channels],
+                             initializer=tf.constant_initializer(0.0))
+
+    # weight decay
+    if name == 'MSOEnet_conv1':
+        reg = 0.5 * tf.nn.l2_loss(weights) * 4e-10
+        tf.add_to_collection('weight_regs', reg)
+
+    # reduced precision: variables stay float32, compute in the input dtype
+    if input_layer.dtype != weights.dtype.base_dtype:
+        weights = tf.cast(weights, input_layer.dtype)
+        biases = tf.cast(biases, input_layer.dtype)
+
+    return weights, biases
+
+
 def conv3d(name, input_layer, kernel_spatial_size,
-           kernel_temporal_size, out_channels, reuse=None):
+           kernel_temporal_size, out_channels, reuse=None,
+           padding='SYMMETRIC'):
     with tf.get_default_graph().name_scope(name):
         with tf.variable_scope(name, reuse=reuse):
-            in_channels = input_layer.get_shape().as_list()[-1]
-
-            if name == 'Gate_conv1':
-                # MSRA initialization (avg variance norm)
-                initializer = tf.contrib.layers \
-                                .variance_scaling_initializer(factor=2.0,
-                                                              mode='FAN_AVG',
-                                                              uniform=False)
-            else:
-                initializer = tf.truncated_normal_initializer(stddev=0.4)
-
-            # going to be sharing variables
-            weights = tf.get_variable('weights',
-                                      [kernel_temporal_size,
-                                       kernel_spatial_size,
-                                       kernel_spatial_size,
-                                       in_channels,
-                                       out_channels],
-                                      initializer=initializer)
-            biases = tf.get_variable('biases',
-                                     [out_channels],
-                                     initializer=tf.constant_initializer(0.0))
-
-            # weight decay
-            if name == 'MSOEnet_conv1':
-                reg = 0.5 * tf.nn.l2_loss(weights) * 4e-10
-                tf.add_to_collection('weight_regs', reg)
-
-            # spatially pad the image, but not temporally
-            input_layer = tf.pad(input_layer,
-                                 [[0, 0], [0, 0],
-                                  [kernel_spatial_size / 2,
-                                   kernel_spatial_size / 2],
-                                  [kernel_spatial_size / 2,
-                                   kernel_spatial_size / 2],
-                                  [0, 0]], 'SYMMETRIC')
+            weights, biases = conv3d_variables(name, input_layer,
+                                               kernel_spatial_size,
+                                               kernel_temporal_size,
+                                               out_channels)
+
+            # spatially pad the image, but not temporally (VALID: the input
+            # is already padded)
+            if padding != 'VALID':
+                input_layer = tf.pad(input_layer,
+                                     [[0, 0], [0, 0],
+                                      [kernel_spatial_size / 2,
+                                       kernel_spatial_size / 2],
+                                      [kernel_spatial_size / 2,
+                                       kernel_spatial_size / 2],
+                                      [0, 0]], padding)
 
             conv_output = tf.nn.conv3d(input_layer, weights,
                                        strides=[1, 1, 1, 1, 1],
@@ -80,6 +167,45 @@ def conv3d(name, input_layer, kernel_spatial_size,
         return tf.nn.bias_add(conv_output, biases)
 
 
+def atlas_pack(name, levels, pad, mode='SYMMETRIC'):
+    """
+    Packs the levels of a pyramid (batch x T x h x w x C, big to small) into
+    a single atlas tensor: every level is spatially padded by pad, level 0
+    is placed on the left and the others are stacked in a column on its
+    right (zeros fill the rest). Returns the atlas and the (y, x) origin of
+    every unpadded level in the atlas once pad has been cropped off, e.g.
+    by a VALID convolution with a 2*pad+1 kernel.
+    """
+    with tf.get_default_graph().name_scope(name):
+        padded = [tf.pad(level, [[0, 0], [0, 0], [pad, pad], [pad, pad],
+                                 [0, 0]], mode)
+                  for level in levels]
+        heights = [tf.shape(level)[2] for level in padded]
+        widths = [tf.shape(level)[3] for level in padded]
+        if len(levels) == 1:
+            return padded[0], [(0, 0)]
+
+        # right column (as wide as the biggest level in it)
+        column = tf.concat([tf.pad(level, [[0, 0], [0, 0], [0, 0],
+                                           [0, widths[1] - width], [0, 0]])
+                            for level, width in zip(padded[1:], widths[1:])],
+                           axis=2)
+        height = tf.maximum(heights[0], tf.add_n(heights[1:]))
+        atlas = tf.concat([tf.pad(padded[0], [[0, 0], [0, 0],
+                                              [0, height - heights[0]],
+                                              [0, 0], [0, 0]]),
+                           tf.pad(column, [[0, 0], [0, 0],
+                                           [0, height - tf.add_n(heights[1:])],
+                                           [0, 0], [0, 0]])],
+                          axis=3)
+
+        origins = [(0, 0)]
+        for i in range(1, len(levels)):
+            origins.append((tf.add_n(heights[1:i]) if i > 1 else 0,
+                            widths[0]))
+        return atlas, origins
+
+
 def deconv3d(name, input_layer, kernel_spatial_size,
              spatial_stride, out_shape, out_channels, reuse=None):
     with tf.get_default_graph().name_scope(name):
@@ -149,14 +275,8 @@ def max_pool3d(name, input_layer, kernel_spatial_size,
 
 
 def blur_downsample3d(name, input_layer, kernel_spatial_size,
-                      spatial_stride, sigma=0.5):
+                      spatial_stride, sigma=0.5, separable=True):
     with tf.get_default_graph().name_scope(name):
-        # gauss kernel
-        w = tf.constant(gauss2d_kernel((kernel_spatial_size,
-                                        kernel_spatial_size), sigma=sigma),
-                        dtype=tf.float32)
-        w = tf.reshape(w, [1, kernel_spatial_size, kernel_spatial_size, 1, 1])
-
         # spatially pad the image sequence, but not temporally
         input_layer = tf.pad(input_layer,
                              [[0, 0], [0, 0],
@@ -166,8 +286,35 @@ def blur_downsample3d(name, input_layer, kernel_spatial_size,
                                kernel_spatial_size / 2],
                               [0, 0]], 'SYMMETRIC')
 
-        return tf.nn.conv3d(input_layer, w,
-                            strides=[1, 1, spatial_stride, spatial_stride, 1],
+        if not separable:
+            # dense gauss kernel
+            w = tf.constant(gauss2d_kernel((kernel_spatial_size,
+                                            kernel_spatial_size),
+                                           sigma=sigma),
+                            dtype=input_layer.dtype)
+            w = tf.reshape(w, [1, kernel_spatial_size,
+                               kernel_spatial_size, 1, 1])
+
+            return tf.nn.conv3d(input_layer, w,
+                                strides=[1, 1, spatial_stride,
+                                         spatial_stride, 1],
+                                padding='VALID')
+
+        # the gauss kernel is separable: vertical pass (already strided, so
+        # only the kept rows are computed) followed by a horizontal pass
+        g = gauss1d_kernel(kernel_spatial_size, sigma=sigma)
+        w_vertical = tf.constant(g.reshape([1, kernel_spatial_size,
+                                            1, 1, 1]),
+                                 dtype=input_layer.dtype)
+        w_horizontal = tf.constant(g.reshape([1, 1, kernel_spatial_size,
+                                              1, 1]),
+                                   dtype=input_layer.dtype)
+
+        vertical = tf.nn.conv3d(input_layer, w_vertical,
+                                strides=[1, 1, spatial_stride, 1, 1],
+                                padding='VALID')
+        return tf.nn.conv3d(vertical, w_horizontal,
+                            strides=[1, 1, 1, spatial_stride, 1],
                             padding='VALID')
 
 
@@ -178,9 +325,30 @@ def eltwise_square(name, input_layer):
 
 def l1_normalize(name, input_layer, axis=4, eps=1e-12):
     with tf.get_default_graph().name_scope(name):
+        # normalize in float32 (eps underflows and the inverse norm can
+        # overflow in reduced precision)
+        dtype = input_layer.dtype
+        input_layer = tf.to_float(input_layer)
         abs_sum = tf.reduce_sum(tf.abs(input_layer), axis, keep_dims=True)
         input_layer_inv_norm = tf.reciprocal(tf.maximum(abs_sum, eps))
-        return tf.multiply(input_layer, input_layer_inv_norm)
+        return tf.cast(tf.multiply(input_layer, input_layer_inv_norm), dtype)
+
+
+def average_gradients(name, tower_grads):
+    """
+    Averages the (gradient, variable) lists returned by compute_gradients
+    for every tower into a single list
+    """
+    with tf.get_default_graph().name_scope(name):
+        average_grads = []
+        for grads_and_vars in zip(*tower_grads):
+            grads = [grad for grad, _ in grads_and_vars if grad is not None]
+            var = grads_and_vars[0][1]
+            if not grads:
+                average_grads.append((None, var))
+                continue
+            average_grads.append((tf.add_n(grads) / len(grads), var))
+        return average_grads
 
 
 def squared_epe(name, input_layer, target):
@@ -200,30 +368,39 @@ def epe(name, input_layer, target, count=None):
             return tf.reduce_mean(loss)
 
 
-def epe_speedsegmented(name, input_layer, target, num_segments):
+def epe_segment_sums(name, input_layer, target, num_segments):
+    """
+    Per-pixel EPE computed once and binned by target speed into the segments
+    [0, 1), [1, 2), [2, 4), ..., [2**(num_segments-2), inf). Returns the EPE
+    sum and pixel count of every segment, so results can be accumulated
+    exactly across chunks.
+    """
     with tf.get_default_graph().name_scope(name):
+        loss = tf.sqrt((input_layer[..., 0] - target[..., 0])**2 +
+                       (input_layer[..., 1] - target[..., 1])**2)
         speed = tf.sqrt(target[..., 0]**2 + target[..., 1]**2)
-        losses = []
-        for i in range(num_segments):
-            if i == 0:
-                start = 0
-                end = 1
-            elif i == num_segments - 1:
-                start = 2**(i-1)
-                end = 2**31 - 1
-            else:
-                start = 2**(i-1)
-                end = 2**i
-            mask = tf.to_float(tf.logical_and(tf.greater_equal(speed, start),
-                                              tf.less(speed, end)))
-            mask = tf.expand_dims(mask, axis=-1)
-            target_masked = target * mask
-            input_masked = input_layer * mask
-            count = tf.reduce_sum(mask)
-            loss = epe('epe_segment_' + str(i), input_masked,
-                       target_masked, count)
-            losses.append(loss)
-        return losses
+
+        # bucketize: segment index is the number of boundaries <= speed
+        boundaries = tf.constant([2.0**i for i in range(num_segments - 1)],
+                                 dtype=speed.dtype)
+        segment = tf.reduce_sum(
+            tf.to_int32(tf.greater_equal(tf.expand_dims(speed, -1),
+                                         boundaries)), axis=-1)
+
+        loss = tf.reshape(loss, [-1])
+        segment = tf.reshape(segment, [-1])
+        sums = tf.unsorted_segment_sum(loss, segment, num_segments)
+        counts = tf.unsorted_segment_sum(tf.ones_like(loss), segment,
+                                         num_segments)
+        return sums, counts
+
+
+def epe_speedsegmented(name, input_layer, target, num_segments):
+    with tf.get_default_graph().name_scope(name):
+        sums, counts = epe_segment_sums('epe_segment_sums', input_layer,
+                                        target, num_segments)
+        # empty segments report 0
+        return tf.unstack(sums / tf.maximum(counts, 1.0), num_segments)
 
 
 def reshape(name, input_layer, output_shape):
@@ -236,13 +413,40 @@ def area_resample(name, input_layer, output_shape):
         return tf.image.resize_area(input_layer, output_shape)
 
 
-def area_resample3d(name, input_layer, output_shape, axis=1):
+def resample3d(name, input_layer, output_shape, resample, axis=1):
+    """
+    Spatially resizes every slice along axis with a single resample op by
+    folding that axis into the batch dimension, so the graph size does not
+    depend on the temporal extent
+    """
     with tf.get_default_graph().name_scope(name):
-        unpacked = tf.unstack(input_layer, axis=axis)
-        for i in range(len(unpacked)):
-            unpacked[i] = area_resample('area_resample', unpacked[i],
-                                        output_shape)
-        return tf.stack(unpacked, axis=axis)
+        if axis != 1:
+            perm = [0, axis] + [d for d in range(1, 5) if d != axis]
+            input_layer = tf.transpose(input_layer, perm)
+        static_shape = input_layer.get_shape().as_list()
+        shape = tf.shape(input_layer)
+
+        # (batch x time) x H x W x C
+        folded = tf.reshape(input_layer,
+                            tf.stack([-1, shape[2], shape[3], shape[4]]))
+        # resize ops always return float32
+        resampled = tf.cast(resample(folded, output_shape), input_layer.dtype)
+
+        # batch x time x h x w x C
+        output = tf.reshape(resampled,
+                            tf.stack([shape[0], shape[1], output_shape[0],
+                                      output_shape[1], shape[4]]))
+        output.set_shape([static_shape[0], static_shape[1], None, None,
+                          static_shape[4]])
+
+        if axis != 1:
+            output = tf.transpose(output, np.argsort(perm))
+        return output
+
+
+def area_resample3d(name, input_layer, output_shape, axis=1):
+    return resample3d(name, input_layer, output_shape,
+                      tf.image.resize_area, axis)
 
 
 def bilinear_resample(name, input_layer, output_shape):
@@ -251,12 +455,8 @@ def bilinear_resample(name, input_layer, output_shape):
 
 
 def bilinear_resample3d(name, input_layer, output_shape, axis=1):
-    with tf.get_default_graph().name_scope(name):
-        unpacked = tf.unstack(input_layer, axis=axis)
-        for i in range(len(unpacked)):
-            unpacked[i] = bilinear_resample('bilinear_resample', unpacked[i],
-                                            output_shape)
-        return tf.stack(unpacked, axis=axis)
+    return resample3d(name, input_layer, output_shape,
+                      tf.image.resize_bilinear, axis)
 
 
 def channel_concat3d(name, input_layer, axis=4):
@@ -274,10 +474,12 @@ def flow_to_colour(name, input_layer, norm=True):
         return draw_hsv_ocv(input_layer, norm)
 
 
-def contrast_norm(name, input_layer, eps=1e-12):
+def contrast_norm(name, input_layer, eps=1e-12, moments=None):
     with tf.get_default_graph().name_scope(name):
-        mean, var = tf.nn.moments(input_layer, axes=[1, 2, 3, 4],
-                                  keep_dims=True)
+        if moments is None:
+            moments = tf.nn.moments(input_layer, axes=[1, 2, 3, 4],
+                                    keep_dims=True)
+        mean, var = moments
         std = tf.sqrt(var + eps)
         return (input_layer - mean) / std
 
@@ -0,0 +1,125 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+from src.Dataset import load_dataset, SHARD_INDEX
+
+
+def pack_split(dataset, sequences, out_dir, split, frame_dtype, flow_dtype,
+               shard_size):
+    shards = []
+    frames_file = None
+    flows_file = None
+    input_shape = None
+    target_shape = None
+    for i, sequence in enumerate(sequences):
+        images, flow = dataset._load_sample(sequence)
+
+        # fixed stride, so every sample of the split must share its shape
+        if input_shape is None:
+            input_shape = list(images.shape)
+            target_shape = list(flow.shape)
+        elif list(images.shape) != input_shape or \
+                list(flow.shape) != target_shape:
+            raise ValueError('pack_split: sample %d of %s has shape %s/%s, '
+                             'expected %s/%s' % (i, split, images.shape,
+                                                 flow.shape, input_shape,
+                                                 target_shape))
+
+        # start the next shard
+        if i % shard_size == 0:
+            if frames_file is not None:
+                frames_file.close()
+                flows_file.close()
+            name = '%s_%05d' % (split, len(shards))
+            prefix = os.path.join(out_dir, name)
+            frames_file = open(prefix + '.frames', 'wb')
+            flows_file = open(prefix + '.flows', 'wb')
+            shards.append({'name': name, 'count': 0})
+
+        if frame_dtype == np.uint8:
+            # grayscale [0, 1] -> [0, 255]
+            images = np.round(np.clip(images, 0.0, 1.0) * 255.0)
+        images.astype(frame_dtype).tofile(frames_file)
+        flow.astype(flow_dtype).tofile(flows_file)
+        shards[-1]['count'] += 1
+
+        if (i + 1) % 1000 == 0:
+            print 'Packed %d/%d %s samples' % (i + 1, len(sequences), split)
+
+    if frames_file is not None:
+        frames_file.close()
+        flows_file.close()
+
+    return {'count': len(sequences), 'shards': shards}, \
+        input_shape, target_shape
+
+
+def pack_shards(dataset, out_dir, frame_dtype='uint8', flow_dtype='float32',
+                shard_size=1024):
+    frame_dtype = np.dtype(frame_dtype)
+    flow_dtype = np.dtype(flow_dtype)
+    if frame_dtype not in (np.uint8, np.float16, np.float32):
+        raise ValueError('pack_shards: unsupported frame dtype %s' %
+                         frame_dtype)
+    if flow_dtype not in (np.float16, np.float32):
+        raise ValueError('pack_shards: unsupported flow dtype %s' %
+                         flow_dtype)
+
+    try:
+        os.makedirs(out_dir)
+    except OSError:
+        if not os.path.isdir(out_dir):
+            raise
+
+    index = {'frame_dtype': frame_dtype.name,
+             'flow_dtype': flow_dtype.name,
+             'shard_size': shard_size,
+             'splits': {}}
+    for split, sequences in [('train', dataset._train),
+                             ('validation', dataset._validation)]:
+        info, input_shape, target_shape = \
+            pack_split(dataset, sequences, out_dir, split, frame_dtype,
+                       flow_dtype, shard_size)
+        index['splits'][split] = info
+        if input_shape is None:
+            continue
+        if 'input_shape' in index and \
+                (index['input_shape'] != input_shape or
+                 index['target_shape'] != target_shape):
+            raise ValueError('pack_shards: train and validation shapes '
+                             'differ')
+        index['input_shape'] = input_shape
+        index['target_shape'] = target_shape
+
+    # the index is written last, a directory without one is incomplete
+    with open(os.path.join(out_dir, SHARD_INDEX), 'w') as f:
+        json.dump(index, f, indent=2)
+
+    print 'Packed %d training and %d validation samples into %s' % \
+        (index['splits']['train']['count'],
+         index['splits']['validation']['count'], out_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, required=True,
+                        help="FlyingChairs or UCF101 data directory")
+    parser.add_argument("--out_dir", type=str, required=True,
+                        help="Directory to write the shards and index to")
+    parser.add_argument("--frame_dtype", type=str, default='uint8',
+                        choices=['uint8', 'float16', 'float32'])
+    parser.add_argument("--flow_dtype", type=str, default='float32',
+                        choices=['float16', 'float32'],
+                        help="float16 halves the flow shards but quantizes "
+                             "the targets (e.g. to 1/16 px at 100 px)")
+    parser.add_argument("--shard_size", type=int, default=1024,
+                        help="Samples per shard file")
+    args = parser.parse_args()
+
+    d = load_dataset(args.data_dir)
+
+    pack_shards(d, args.out_dir, args.frame_dtype, args.flow_dtype,
+                args.shard_size)
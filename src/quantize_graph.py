@@ -0,0 +1,205 @@
+import os
+import argparse
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.framework import attr_value_pb2
+from tensorflow.python.framework import tensor_util
+
+from src.utilities import read_graph_def, load_graph
+from src.graph_components import epe_segment_sums
+from src.Dataset import load_dataset
+from src.evaluation import segment_epe, print_epe_comparison
+
+# convolutions whose weights and inputs are quantized (MSOEnet_conv3 decodes
+# the flow and is kept in float32)
+QUANTIZE_SCOPES = ['MSOEnet_conv1', 'MSOEnet_conv2', 'conv3d',
+                   'Gate_conv1', 'Gate_conv2', 'Gate_conv3']
+
+
+def node_input_name(name):
+    """ Node name of an input ('^node', 'node:1' -> 'node') """
+    return name.lstrip('^').split(':')[0]
+
+
+def quantized_convolutions(graph_def, scopes=QUANTIZE_SCOPES):
+    """
+    Returns [(Conv3D node, weights Const node)] of every convolution in a
+    frozen MSOEmultiscale graph whose weights are <scope>/weights for one of
+    scopes (the weights may be read through Identity nodes)
+    """
+    nodes = dict((node.name, node) for node in graph_def.node)
+    weights_names = set(scope + '/weights' for scope in scopes)
+
+    convolutions = []
+    for node in graph_def.node:
+        if node.op != 'Conv3D':
+            continue
+        weights = nodes[node_input_name(node.input[1])]
+        while weights.op == 'Identity':
+            weights = nodes[node_input_name(weights.input[0])]
+        if weights.op == 'Const' and weights.name in weights_names:
+            convolutions.append((node, weights))
+    return convolutions
+
+
+def calibrate(graph_def, convolutions, batches, input_name='input:0'):
+    """
+    Runs the float graph over batches and returns {Conv3D node name: (min,
+    max)} of the activations going into every convolution
+    """
+    graph = load_graph(graph_def, name='')
+    input = graph.get_tensor_by_name(input_name)
+    tensors = dict((conv.name, graph.get_tensor_by_name(
+                        conv.input[0] if ':' in conv.input[0]
+                        else conv.input[0] + ':0'))
+                   for conv, _ in convolutions)
+    names = tensors.keys()
+    fetches = [[tf.reduce_min(tensors[name]), tf.reduce_max(tensors[name])]
+               for name in names]
+
+    ranges = {}
+    with tf.Session(graph=graph) as sess:
+        for batch in batches:
+            results = sess.run(fetches, feed_dict={input: batch})
+            for name, (low, high) in zip(names, results):
+                if name in ranges:
+                    low = min(low, ranges[name][0])
+                    high = max(high, ranges[name][1])
+                ranges[name] = (float(low), float(high))
+    return ranges
+
+
+def quantize_weights(weights, num_bits=8):
+    """
+    Symmetric per-output-channel quantization of a conv3d weights tensor
+    (T x H x W x in x out). Returns the integer weights and the scales.
+    """
+    levels = 2**(num_bits - 1) - 1
+    scales = np.abs(weights).reshape(-1, weights.shape[-1]).max(axis=0)
+    scales = np.maximum(scales, 1e-12) / levels
+    quantized = np.round(weights / scales).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def quantize_graph(graph_def, ranges, num_bits=8):
+    """
+    Returns a copy of a frozen MSOEmultiscale graph in which the weights of
+    the QUANTIZE_SCOPES convolutions are stored as int8 constants
+    (dequantized per output channel) and their inputs pass through 8 bit
+    fake quantization with the calibrated ranges
+    """
+    output_graph_def = tf.GraphDef()
+    output_graph_def.CopyFrom(graph_def)
+    convolutions = quantized_convolutions(output_graph_def)
+
+    # weights: Const -> int8 Const, Cast and per-channel scale Mul, keeping
+    # the node name so that its consumers are untouched
+    dequantized = set()
+    for _, weights in convolutions:
+        if weights.name in dequantized:
+            continue
+        dequantized.add(weights.name)
+        value = tensor_util.MakeNdarray(weights.attr['value'].tensor)
+        quantized, scales = quantize_weights(value, num_bits)
+
+        int8_weights = output_graph_def.node.add()
+        int8_weights.op = 'Const'
+        int8_weights.name = weights.name + '_int8'
+        int8_weights.attr['dtype'].type = tf.int8.as_datatype_enum
+        int8_weights.attr['value'].tensor.CopyFrom(
+            tensor_util.make_tensor_proto(quantized, tf.int8))
+
+        scale = output_graph_def.node.add()
+        scale.op = 'Const'
+        scale.name = weights.name + '_scale'
+        scale.attr['dtype'].type = tf.float32.as_datatype_enum
+        scale.attr['value'].tensor.CopyFrom(
+            tensor_util.make_tensor_proto(scales, tf.float32))
+
+        cast = output_graph_def.node.add()
+        cast.op = 'Cast'
+        cast.name = weights.name + '_dequantize'
+        cast.input.append(int8_weights.name)
+        cast.attr['SrcT'].type = tf.int8.as_datatype_enum
+        cast.attr['DstT'].type = tf.float32.as_datatype_enum
+
+        weights.op = 'Mul'
+        weights.ClearField('attr')
+        weights.input.extend([cast.name, scale.name])
+        weights.attr['T'].type = tf.float32.as_datatype_enum
+
+    # activations: fake quantize the input of every convolution
+    for conv, _ in convolutions:
+        low, high = ranges[conv.name]
+        fake_quant = output_graph_def.node.add()
+        fake_quant.op = 'FakeQuantWithMinMaxArgs'
+        fake_quant.name = conv.name + '_input_quant'
+        fake_quant.input.append(conv.input[0])
+        fake_quant.attr['min'].CopyFrom(attr_value_pb2.AttrValue(f=low))
+        fake_quant.attr['max'].CopyFrom(attr_value_pb2.AttrValue(f=high))
+        fake_quant.attr['num_bits'].CopyFrom(
+            attr_value_pb2.AttrValue(i=num_bits))
+        conv.input[0] = fake_quant.name
+
+    return output_graph_def
+
+
+def evaluate_graph(graph_def, batches, num_segments=8,
+                   input_name='input:0',
+                   output_name='MSOEmultiscale/reshape/Reshape:0'):
+    """
+    Returns the validation EPE (overall, per speed segment, segment pixel
+    counts) of a frozen graph and its seconds per batch
+    """
+    graph = load_graph(graph_def, name='')
+    with graph.as_default():
+        input = graph.get_tensor_by_name(input_name)
+        output = graph.get_tensor_by_name(output_name)
+        target = tf.placeholder(dtype=tf.float32, shape=[None, None, None, 2])
+        val_epe_sums, val_epe_counts = \
+            epe_segment_sums('validation_epe_segmented', output, target,
+                             num_segments)
+
+    with tf.Session(graph=graph) as sess:
+        return segment_epe(sess, val_epe_sums, val_epe_counts, input, target,
+                           batches)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frozen_graph", type=str, required=True,
+                        help="Float frozen graph (see src/freeze_graph.py)")
+    parser.add_argument("--train_filename", type=str, required=True,
+                        help="Dataset whose validation split is used for "
+                             "calibration and the report")
+    parser.add_argument("--calibration_batches", type=int, default=16,
+                        help="Validation batches to calibrate ranges on")
+    parser.add_argument("--batch_size", type=int, default=4)
+    args = parser.parse_args()
+
+    d = load_dataset(args.train_filename)
+    float_graph_def = read_graph_def(args.frozen_graph)
+
+    # calibrate on the first validation batches
+    batches = d.validation_batches(args.batch_size)
+    calibration = [input for _, (input, _) in
+                   zip(range(args.calibration_batches), batches)]
+    batches.close()
+    ranges = calibrate(float_graph_def,
+                       quantized_convolutions(float_graph_def), calibration)
+
+    int8_graph_def = quantize_graph(float_graph_def, ranges)
+    output_graph = os.path.splitext(args.frozen_graph)[0] + '_int8.tfmodel'
+    with tf.gfile.GFile(output_graph, "wb") as f:
+        f.write(int8_graph_def.SerializeToString())
+    print 'Quantized %d convolutions into %s (%d -> %d bytes)' % \
+        (len(ranges), output_graph, float_graph_def.ByteSize(),
+         int8_graph_def.ByteSize())
+
+    # accuracy and latency report
+    reference = evaluate_graph(float_graph_def,
+                               d.validation_batches(args.batch_size))
+    quantized = evaluate_graph(int8_graph_def,
+                               d.validation_batches(args.batch_size))
+    print_epe_comparison(reference, quantized, 'float32', 'int8')
@@ -1,4 +1,11 @@
 import os
+import re
+import sys
+import glob
+import ctypes
+import shutil
+import threading
+import Queue
 import numpy as np
 import cv2
 import tensorflow as tf
@@ -22,6 +29,38 @@ def load_image(path, mean_sub=False):
     return np.expand_dims(gray_scaled, 3)  # grayscale [0, 1]
 
 
+def read_ppm_rows(path, y, height):
+    """
+    Rows y to y+height of a binary 8-bit RGB (P6) PPM file, reading only
+    those rows; None for any other format
+    """
+    with open(path, 'rb') as f:
+        header = []
+        while len(header) < 4:
+            line = f.readline()
+            if not line:
+                return None
+            header += line.split('#', 1)[0].split()
+        if len(header) != 4 or header[0] != 'P6' or int(header[3]) > 255:
+            return None
+        width = int(header[1])
+        f.seek(y * width * 3, os.SEEK_CUR)
+        rows = np.fromfile(f, dtype=np.uint8, count=height * width * 3)
+        return rows.reshape((height, width, 3))
+
+
+def load_image_crop(path, y, x, height, width):
+    """
+    load_image(path)[y:y+height, x:x+width], reading only the rows of the
+    crop from PPM files
+    """
+    rgb = read_ppm_rows(path, y, height) if path.endswith('.ppm') else None
+    if rgb is None:
+        return load_image(path)[y:y + height, x:x + width]
+    gray = rgb2gray(rgb[:, x:x + width]).astype('float32')
+    return np.expand_dims(gray / 255.0, 2)  # grayscale [0, 1]
+
+
 def readFlowFile(filename):
     """
     readFlowFile read a flow file FILENAME into 2-band image IMG
@@ -62,13 +101,13 @@ def readFlowFile(filename):
     if len(filename) == 0:
         raise ValueError('readFlowFile: empty filename')
 
-    try:
-        idx = filename.index('.')
-    except ValueError:
+    # extension of the file name only (directories may contain dots)
+    extension = os.path.splitext(filename)[1]
+    if not extension:
         raise ValueError('readFlowFile: extension required in filename %s' %
                          (filename))
 
-    if filename[idx:] != '.flo':
+    if extension != '.flo':
         raise ValueError('readFlowFile: filename %s should have extension '
                          '\'.flo\'' % (filename))
 
@@ -98,6 +137,64 @@ def readFlowFile(filename):
         return img
 
 
+def readFlowShape(filename):
+    """
+    Returns the (height, width) of a .flo file, reading only its header
+    """
+    TAG_FLOAT = 202021.25  # check for this when READING the file
+
+    with open(filename, 'rb') as fid:
+        tag = np.fromfile(fid, count=1, dtype=np.float32).item()
+        width, height = np.fromfile(fid, count=2, dtype=np.int32)
+
+        # sanity check
+        if tag != TAG_FLOAT:
+            raise ValueError('readFlowShape(%s): wrong tag (possibly due to'
+                             ' big-endian machine?)' % (filename))
+
+        return int(height), int(width)
+
+
+def readFlowCrop(filename, y, x, height, width):
+    """
+    readFlowFile(filename)[y:y+height, x:x+width], reading only the rows of
+    the crop
+    """
+    full_width = readFlowShape(filename)[1]
+    nBands = 2
+
+    with open(filename, 'rb') as fid:
+        # skip the header (tag, width, height) and the rows above the crop
+        fid.seek(12 + y * full_width * nBands * 4)
+        tmp = np.fromfile(fid, count=nBands*full_width*height,
+                          dtype=np.float32)
+        img = tmp.reshape((height, full_width, nBands))
+
+        return img[:, x:x + width]
+
+
+def writeFlowFile(filename, flow):
+    """
+    writeFlowFile writes a 2-band image FLOW into a .flo file FILENAME,
+    the inverse of readFlowFile
+    """
+    TAG_FLOAT = 202021.25
+
+    if not filename.endswith('.flo'):
+        raise ValueError('writeFlowFile: filename %s should have extension '
+                         '\'.flo\'' % (filename))
+
+    height, width, nBands = flow.shape
+    if nBands != 2:
+        raise ValueError('writeFlowFile(%s): flow must have 2 bands, got %d'
+                         % (filename, nBands))
+
+    with open(filename, 'wb') as fid:
+        np.array([TAG_FLOAT], dtype=np.float32).tofile(fid)
+        np.array([width, height], dtype=np.int32).tofile(fid)
+        flow.astype(np.float32).tofile(fid)
+
+
 def draw_hsv(flow):
     h, w = flow.shape[:2]
     fx, fy = flow[:, :, 0], flow[:, :, 1]
@@ -176,51 +273,107 @@ def gauss2d_kernel(shape=(3, 3), sigma=0.5):
     return h
 
 
-def check_snapshots(run_id):
-    snapshots_folder = 'snapshots/' + run_id + '/'
-    logs_folder = 'logs/' + run_id + '/'
-
-    checkpoint = tf.train.latest_checkpoint(snapshots_folder)
-
-    resume = False
-    start_iteration = 0
-
-    if checkpoint:
-        choice = ''
-        while choice != 'y' and choice != 'n':
-            print 'Snapshot file detected (' + checkpoint + \
-                  ') would you like to resume? (y/n)'
-            choice = raw_input().lower()
-
-            if choice == 'y':
-                resume = checkpoint
-                start_iteration = int(checkpoint.split(snapshots_folder)
-                                      [1][6:])
-                print 'resuming from iteration ' + str(start_iteration)
-            else:
-                print 'removing old snapshots and logs, training from' \
-                      ' scratch'
-                resume = False
-                for file in os.listdir(snapshots_folder):
-                    if file == '.gitignore':
-                        continue
-                    os.remove(snapshots_folder + file)
-                for file in os.listdir(logs_folder):
-                    if file == '.gitignore':
-                        continue
-                    os.remove(logs_folder + file)
-    else:
+def gauss1d_kernel(size=3, sigma=0.5):
+    """
+    1D gaussian mask, the separable factor of gauss2d_kernel:
+    np.outer(gauss1d_kernel(n, s), gauss1d_kernel(n, s)) matches
+    gauss2d_kernel((n, n), s) up to its eps cutoff
+    """
+    m = (size-1.)/2.
+    x = np.arange(-m, m+1)
+    h = np.exp(-(x*x) / (2.*sigma*sigma))
+    h[h < np.finfo(h.dtype).eps*h.max()] = 0
+    sumh = h.sum()
+    if sumh != 0:
+        h /= sumh
+    return h
+
+
+def checkpoint_step(checkpoint):
+    """ Global step of a checkpoint path (.../iter-00010000 -> 10000) """
+    match = re.search(r'-(\d+)$', checkpoint)
+    return int(match.group(1)) if match else None
+
+
+def is_valid_checkpoint(checkpoint):
+    """ Whether the checkpoint is complete and readable """
+    try:
+        tf.train.NewCheckpointReader(checkpoint)
+        return True
+    except tf.errors.OpError:
+        return False
+
+
+def latest_checkpoint(folder, require_step=False):
+    """
+    Returns the newest readable checkpoint of folder (falling back to older
+    ones when the newest was cut short, e.g. by preemption), or None. Only
+    checkpoints with a -<step> suffix are ranked; unless require_step is
+    set, a folder without any falls back to the checkpoint its state file
+    points at (e.g. final_model/MSOEnet.ckpt)
+    """
+    candidates = []
+    state = tf.train.get_checkpoint_state(folder)
+    if state:
+        candidates.extend(state.all_model_checkpoint_paths)
+        candidates.append(state.model_checkpoint_path)
+    # checkpoints missing from (or left out of a corrupt) state file
+    candidates.extend(path[:-len('.index')] for path in
+                      glob.glob(os.path.join(folder, '*.index')))
+
+    stepped = [candidate for candidate in set(candidates)
+               if checkpoint_step(candidate) is not None]
+    for checkpoint in sorted(stepped, key=checkpoint_step, reverse=True):
+        if is_valid_checkpoint(checkpoint):
+            return checkpoint
+
+    if require_step:
+        return None
+    if state and is_valid_checkpoint(state.model_checkpoint_path):
+        return state.model_checkpoint_path
+    return tf.train.latest_checkpoint(folder)
+
+
+def check_snapshots(run_id, resume=True):
+    """
+    Returns the checkpoint to resume the run from (False if none) and the
+    iteration to start at. Never prompts: the latest valid snapshot is
+    resumed unless resume is False, in which case the snapshots and logs of
+    the run are removed.
+    """
+    snapshots_folder = 'snapshots/' + run_id
+    logs_folder = 'logs/' + run_id
+
+    if resume:
+        checkpoint = latest_checkpoint(snapshots_folder, require_step=True)
+        if checkpoint:
+            start_iteration = checkpoint_step(checkpoint)
+            print 'Resuming from ' + checkpoint + ' (iteration ' + \
+                str(start_iteration) + ')'
+            return checkpoint, start_iteration
         print "No snapshots found, training from scratch"
+    else:
+        print 'Removing old snapshots and logs, training from scratch'
+        for folder in [snapshots_folder, logs_folder]:
+            shutil.rmtree(folder, ignore_errors=True)
 
-    return resume, start_iteration
+    return False, 0
 
 
-def load_graph(frozen_graph_filename, name=None, input_map=None):
+def read_graph_def(frozen_graph_filename):
     # We load the protobuf file from the disk and parse it to retrieve the
     # unserialized graph_def
     with tf.gfile.GFile(frozen_graph_filename, "rb") as f:
         graph_def = tf.GraphDef()
         graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def load_graph(frozen_graph_filename, name=None, input_map=None):
+    if isinstance(frozen_graph_filename, tf.GraphDef):
+        graph_def = frozen_graph_filename
+    else:
+        graph_def = read_graph_def(frozen_graph_filename)
 
     # Then, we can use again a convenient built-in function to import a
     # graph_def into the current default Graph
@@ -236,6 +389,52 @@ def load_graph(frozen_graph_filename, name=None, input_map=None):
     return graph
 
 
+def prefetch(iterable, depth=2):
+    """
+    Iterate over iterable from a background thread, keeping up to depth items
+    ready ahead of the consumer. Exceptions raised while producing are
+    re-raised in the consumer.
+    """
+    items = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # give up once the consumer has gone away
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception:
+            put((done, sys.exc_info()))
+            return
+        put((done, None))
+
+    t = threading.Thread(target=producer)
+    t.daemon = True  # thread will close when parent quits
+    t.start()
+
+    try:
+        while True:
+            item, exc_info = items.get()
+            if item is done:
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 def get_immediate_subdirectories(a_dir):
     return sorted([os.path.join(a_dir, name) for name in os.listdir(a_dir)
                    if os.path.isdir(os.path.join(a_dir, name))])
@@ -244,3 +443,63 @@ def get_immediate_subdirectories(a_dir):
 def get_immediate_subfiles(a_dir):
     return sorted([os.path.join(a_dir, name) for name in os.listdir(a_dir)
                    if os.path.isfile(os.path.join(a_dir, name))])
+
+
+def parse_cpulist(cpulist):
+    """ '0-3,8,10-11' (Linux cpulist format) -> [0, 1, 2, 3, 8, 10, 11] """
+    cores = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cores.extend(range(int(first), int(last) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def numa_node_cores(node):
+    """ Cores of a NUMA node, as listed by sysfs """
+    with open('/sys/devices/system/node/node%d/cpulist' % node, 'r') as f:
+        return parse_cpulist(f.read())
+
+
+def set_affinity(cores):
+    """
+    Pin the calling thread (and the threads it creates from now on) to the
+    given cores. No-op when cores is empty or on non-Linux hosts.
+    """
+    if not cores or not sys.platform.startswith('linux'):
+        return
+    mask_type = ctypes.c_ulong * (max(cores) / (8 * ctypes.sizeof(
+        ctypes.c_ulong)) + 1)
+    mask = mask_type()
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    for core in cores:
+        mask[core / bits] |= 1 << (core % bits)
+    libc = ctypes.CDLL(None, use_errno=True)
+    # pid 0 is the calling thread
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)):
+        errno = ctypes.get_errno()
+        raise OSError(errno, 'sched_setaffinity: %s' % os.strerror(errno))
+
+
+def make_session_config(tf_config, user_config):
+    """
+    Applies the CPU execution settings of user_config (intra_op_threads,
+    inter_op_threads) to tf_config and returns the cores the compute
+    threads should be pinned to (compute_cores, else the cores of
+    numa_node, else None)
+    """
+    if user_config.get('intra_op_threads') is not None:
+        tf_config.intra_op_parallelism_threads = \
+            user_config['intra_op_threads']
+    if user_config.get('inter_op_threads') is not None:
+        tf_config.inter_op_parallelism_threads = \
+            user_config['inter_op_threads']
+
+    compute_cores = user_config.get('compute_cores')
+    if compute_cores is None and user_config.get('numa_node') is not None:
+        compute_cores = numa_node_cores(user_config['numa_node'])
+    return compute_cores
@@ -1,8 +1,7 @@
+import os
+import sys
 import tensorflow as tf
-import cv2
-import numpy as np
-from src.architecture import MSOEPyramid
-from src.util import draw_hsv
+from src.InferenceEngine import InferenceEngine, StreamingInferenceEngine
 from subprocess import call
 
 # config
@@ -11,38 +10,40 @@ config_proto.gpu_options.allow_growth = True
 config_proto.allow_soft_placement = True
 config_proto.log_device_placement = False
 my_config = {}
-my_config['train'] = False
-my_config['num_scales'] = 4
+# export it first with
+#   python -m src.freeze_graph --model_folder final_model/symmetry \
+#       --precision float32
+my_config['frozen_graph'] = \
+    'final_model/symmetry/MSOEmultiscale_float32.tfmodel'
+my_config['frames'] = 'test_images/fish/frame_*.jpeg'
+my_config['output_dir'] = 'test_images/fish'
+my_config['batch_size'] = 8
+my_config['streaming'] = True  # reuse per-frame features across pairs
+my_config['num_scales'] = 5
+# e.g. 1024 for 4K footage (non-streaming); the tiles overlap by ~190px
+# on every side, so small tiles mostly recompute their overlap
+my_config['tile_size'] = None
 
-with tf.device('/gpu:1'):
-    scale_factor = 1.0 / 255.0
+if not os.path.isfile(my_config['frozen_graph']):
+    sys.exit(my_config['frozen_graph'] + ' not found, export it with '
+             'src/freeze_graph.py first (see above)')
 
-    for i in range(1, 40):
-        input1 = cv2.imread('test_images/oatmeal_8/frame_%08d.jpeg' % (i),
-                            cv2.IMREAD_GRAYSCALE).astype(np.float32) * \
-            scale_factor
-        input2 = cv2.imread('test_images/oatmeal_8/frame_%08d.jpeg' % (i+1),
-                            cv2.IMREAD_GRAYSCALE).astype(np.float32) * \
-            scale_factor
-        stacked = np.expand_dims(
-                      np.expand_dims(np.stack([input1, input2]), axis=3),
-                      axis=0)
-        if i != 1:
-            input = np.concatenate((input, stacked), axis=0)
-        else:
-            input = stacked
+if my_config['streaming']:
+    engine = StreamingInferenceEngine(my_config['frozen_graph'],
+                                      my_config['num_scales'],
+                                      batch_size=my_config['batch_size'],
+                                      config=config_proto)
+else:
+    engine = InferenceEngine(my_config['frozen_graph'],
+                             batch_size=my_config['batch_size'],
+                             config=config_proto,
+                             tile_size=my_config['tile_size'])
+count = engine.run(my_config['frames'], my_config['output_dir'],
+                   write_flo=False, write_visualization=True)
+engine.close()
+print str(count) + ' flows computed'
 
-    print input.shape
-
-    net = MSOEPyramid(config={'tf': config_proto,
-                              'user': my_config}, input=input)
-    result = net.run_test()
-
-    for i in range(0, 39):
-        filename = 'test_images/oatmeal_8/img_%08d.jpeg' % (i)
-        cv2.imwrite(filename, draw_hsv(result[i]))
-
-    call('convert -delay 10 -loop 0 -alpha set -dispose previous '
-         '`ls -v test_images/oatmeal_8/img_*.jpeg` '
-         'test_images/oatmeal_8/img.gif',
-         shell=True)
+call('convert -delay 10 -loop 0 -alpha set -dispose previous '
+     '`ls -v ' + my_config['output_dir'] + '/img_*.jpeg` ' +
+     my_config['output_dir'] + '/img.gif',
+     shell=True)
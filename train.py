@@ -6,19 +6,41 @@ config_proto = tf.ConfigProto()
 config_proto.gpu_options.allow_growth = True
 config_proto.allow_soft_placement = True
 config_proto.log_device_placement = False
-# config.intra_op_parallelism_threads = 1
 my_config = {}
 my_config['train_filename'] = \
     '/local/ssd/mtesfald/FlyingChairs/data'
 my_config['batch_size'] = 4
 my_config['iterations'] = 600000
 my_config['snapshot_frequency'] = 10000
+my_config['resume'] = True  # False discards the run's snapshots and logs
+my_config['keep_last_snapshots'] = 5
+my_config['keep_snapshot_every'] = 100000  # iterations, None keeps none
 my_config['print_frequency'] = 10
 my_config['validation_frequency'] = 500
 my_config['lr'] = 6e-3
 my_config['num_threads'] = 6
+my_config['num_processes'] = 0
+my_config['augment'] = False  # random quarter-turn rotations (loaders)
+# in-graph affine and photometric augmentation, e.g. {} for the defaults
+# of graph_components.AUGMENTATION_DEFAULTS (None disables it)
+my_config['augmentation'] = None
+# train on random [height, width] crops (None for full frames), taking
+# patches_per_sample of them from every loaded sample
+my_config['crop_size'] = None
+my_config['patches_per_sample'] = 1
 my_config['num_scales'] = 5
 my_config['gpu'] = 0
+# CPU execution (None leaves the TensorFlow defaults)
+# my_config['device'] = '/cpu:0'
+my_config['intra_op_threads'] = None
+my_config['inter_op_threads'] = None
+my_config['compute_cores'] = None  # e.g. range(0, 16)
+my_config['loader_cores'] = None  # e.g. range(16, 20)
+my_config['numa_node'] = None  # compute on the cores of this node
+my_config['feed_train_data'] = False
+# data-parallel towers (gradients averaged before the Adam update)
+my_config['num_towers'] = 1
+# my_config['tower_devices'] = ['/gpu:0', '/gpu:1']
 my_config['run_id'] = 'scale_space_gating_upconv_contrastnorm'
 
 net = MSOEmultiscale(config={'tf': config_proto,